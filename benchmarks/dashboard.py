@@ -0,0 +1,223 @@
+#! /usr/bin/env python3
+#
+# Benchmark of the autoproj dashboard's hot paths
+#
+# Generates a synthetic build_reports/ tree in a temporary directory, and
+# measures the latency and peak memory of rendering the dashboard, fetching
+# the packages of a build, fetching logs and fetching test results. The
+# Buildbot data API is replaced by a stub, so this runs fully offline.
+#
+# Usage: benchmarks/dashboard.py [--builds N] [--packages M] [--logs K]
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'master'))
+import dashboard
+
+PHASES = ['import', 'build', 'test']
+BUILDERS = ['rock-core:master', 'rock-core:feature/a', 'rock-core:feature/b']
+
+class StubDataAPI:
+    """Minimal replacement for the Buildbot data API used by the dashboard"""
+
+    def __init__(self, builds, builders):
+        self.builds = builds
+        self.builders = builders
+        self.calls = 0
+
+    def dataGet(self, path, limit=None, offset=0, order=None):
+        self.calls += 1
+        if path == "/builders":
+            return self.builders
+        elif path == "/builds":
+            builds = sorted(self.builds, key=lambda b: -b['buildid'])
+            if limit is None:
+                return builds[offset:]
+            return builds[offset:offset + limit]
+        else:
+            return {}
+
+def generate_package(rng, test_failure_rate):
+    pkg = {}
+    for phase in PHASES:
+        success = phase != 'test' or rng.random() > test_failure_rate
+        pkg[phase] = {
+            'invoked': True,
+            'cached': rng.random() < 0.5,
+            'success': success
+        }
+    return pkg
+
+def generate_reports(basedir, builds, packages, logs, log_size,
+                     test_failure_rate=0.05, seed=0):
+    """Generate a synthetic build_reports/ tree and the matching API data
+
+    Returns the stub data API
+    """
+
+    rng = random.Random(seed)
+    log_line = b"x" * 79 + b"\n"
+    log_contents = log_line * max(1, log_size // len(log_line))
+    package_names = [f"group{i % 20}/package{i}" for i in range(packages)]
+
+    api_builders = [
+        { 'builderid': i, 'name': 'rock-core-build', 'virtual_builder_name': name }
+        for i, name in enumerate(BUILDERS)
+    ]
+    api_builds = []
+    for buildid in range(builds):
+        builderid = buildid % len(BUILDERS)
+        number = buildid // len(BUILDERS)
+        api_builds.append({
+            'buildid': buildid,
+            'builderid': builderid,
+            'number': number,
+            'results': 0
+        })
+
+        reports_name = f"{BUILDERS[builderid]}-{number}".replace('/', ':')
+        report_dir = basedir / 'build_reports' / reports_name
+        report = { 'packages': {} }
+        for name in package_names:
+            report['packages'][name] = generate_package(rng, test_failure_rate)
+
+            elements = name.split('/')
+            basename = elements.pop()
+            logdir = report_dir.joinpath('logs', *elements)
+            logdir.mkdir(parents=True, exist_ok=True)
+            for log_index in range(logs):
+                log_type = PHASES[log_index] if log_index < len(PHASES) else f"log{log_index}"
+                (logdir / f"{basename}-{log_type}.log").write_bytes(log_contents)
+
+            testdir = report_dir.joinpath('logs', 'test-results', *elements)
+            testdir.mkdir(parents=True, exist_ok=True)
+            (testdir / f"{basename}.html").write_bytes(log_contents)
+
+        with open(report_dir / 'report.json', 'w') as f:
+            f.write(json.dumps(report))
+
+    return StubDataAPI(api_builds, api_builders)
+
+def measure(name, fn, iterations):
+    latencies = []
+    tracemalloc.start()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'name': name,
+        'median_ms': statistics.median(latencies) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'peak_memory_kB': peak / 1024
+    }
+
+def get(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError(f"{url} returned {response.status_code}")
+    # Consume streamed responses
+    response.get_data()
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        basedir = Path(tmpdir)
+        api = generate_reports(basedir, args.builds, args.packages,
+                               args.logs, args.log_size)
+        os.chdir(basedir)
+
+        app = dashboard.Create('Benchmark')
+        app.buildbot_api = api
+        client = app.test_client()
+
+        builds = dashboard.index_builders(api.builders)
+        reports_names = [dashboard.build_names(b, builds)[2] for b in api.builds]
+        reports_name = reports_names[0]
+
+        def cold_package_info():
+            dashboard.report_cache.clear()
+            for name in reports_names:
+                dashboard.package_info_for(name)
+
+        def warm_package_info():
+            for name in reports_names:
+                dashboard.package_info_for(name)
+
+        def index_reports():
+            for name in reports_names:
+                dashboard.write_dashboard_index(Path('build_reports') / name)
+
+        results.append(measure("package_info_for (cold, walk)", cold_package_info, args.iterations))
+        results.append(measure("package_info_for (warm)", warm_package_info, args.iterations))
+        results.append(measure("compute_build_info",
+            lambda: dashboard.compute_build_info(api.builds, api.builders), args.iterations))
+        results.append(measure("build_summary",
+            lambda: dashboard.build_summary(dashboard.package_info_for(reports_name)),
+            args.iterations))
+
+        dashboard.report_cache.clear()
+        api.calls = 0
+        results.append(measure("page render (cold cache)",
+            lambda: get(client, "/index.html"), 1))
+        results.append(measure("page render (warm cache)",
+            lambda: get(client, "/index.html"), args.iterations))
+        api_calls = api.calls / (args.iterations + 1)
+
+        results.append(measure("write_dashboard_index", index_reports, 1))
+        results.append(measure("package_info_for (cold, index)", cold_package_info, args.iterations))
+
+        packagename = 'group0/package0'
+        results.append(measure("build packages (JSON)",
+            lambda: get(client, f"/api/builds/{reports_name}/packages.json"),
+            args.iterations))
+        results.append(measure("log fetch",
+            lambda: get(client, f"/logs/{reports_name}/{packagename}/build"),
+            args.iterations))
+        results.append(measure("log fetch (tail=100)",
+            lambda: get(client, f"/logs/{reports_name}/{packagename}/build?tail=100"),
+            args.iterations))
+        results.append(measure("test results fetch",
+            lambda: get(client, f"/test-results/{reports_name}/{packagename}"),
+            args.iterations))
+
+    return (results, api_calls)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the autoproj dashboard")
+    parser.add_argument('--builds', type=int, default=30, help="number of builds")
+    parser.add_argument('--packages', type=int, default=400, help="packages per build")
+    parser.add_argument('--logs', type=int, default=3, help="logs per package")
+    parser.add_argument('--log-size', type=int, default=16 * 1024,
+                        help="size of each log and test result file, in bytes")
+    parser.add_argument('--iterations', type=int, default=5,
+                        help="number of iterations per measurement")
+    parser.add_argument('--json', action='store_true', help="output results as JSON")
+    args = parser.parse_args(argv)
+
+    results, api_calls = run(args)
+    if args.json:
+        print(json.dumps({ 'results': results, 'api_calls_per_render': api_calls }, indent=2))
+        return
+
+    print(f"{args.builds} builds x {args.packages} packages x {args.logs} logs")
+    print(f"{'benchmark':<34} {'median ms':>10} {'max ms':>10} {'peak kB':>10}")
+    for r in results:
+        print(f"{r['name']:<34} {r['median_ms']:>10.2f} {r['max_ms']:>10.2f} {r['peak_memory_kB']:>10.0f}")
+    print(f"data API calls per page render: {api_calls:.1f}")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
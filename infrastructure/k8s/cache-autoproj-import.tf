@@ -2,6 +2,35 @@
 #
 # Volume mounted directly in the build pods. Buildbot has a separate
 # worker to update it regularly
+#
+# It is a GCE disk exposed as a NFSv4 server, like the build cache. A GCE
+# disk cannot be attached read/write to the updater and read-only to the
+# builds at the same time, and the import cache generations let the update
+# run while builds are using the cache
+resource "kubernetes_service" "cache-autoproj-import" {
+    metadata {
+        name = "cache-autoproj-import"
+    }
+
+    spec {
+        selector = {
+            app = kubernetes_deployment.cache-autoproj-import-server.metadata.0.labels.app
+        }
+        port {
+            name = "nfs4"
+            port = 2049
+        }
+        port {
+            name = "mountd"
+            port = 20048
+        }
+        port {
+            name = "rpcbind"
+            port = 111
+        }
+    }
+}
+
 resource "google_compute_disk" "cache-autoproj-import" {
     name  = "cache-autoproj-import"
     type  = "pd-standard"
@@ -18,14 +47,16 @@ resource "kubernetes_persistent_volume" "cache-autoproj-import" {
         capacity = {
             storage = "10Gi"
         }
+        # Without this, the claim (where class_name == "standard") would
+        # not match
         storage_class_name = "standard"
-        access_modes = ["ReadOnlyMany"]
+        access_modes = ["ReadWriteMany"]
         persistent_volume_source {
-            gce_persistent_disk {
-                pd_name = google_compute_disk.cache-autoproj-import.name
-                read_only = true
+            nfs {
+                # MUST MATCH the path exported by the cache-autoproj-import-server pod
+                path = "/exports"
+                server = "${kubernetes_service.cache-autoproj-import.metadata.0.name}.default.svc.cluster.local"
             }
-
         }
     }
 }
@@ -36,7 +67,7 @@ resource "kubernetes_persistent_volume_claim" "cache-autoproj-import" {
     }
 
     spec {
-        access_modes = ["ReadOnlyMany"]
+        access_modes = ["ReadWriteMany"]
         resources {
             requests = {
                 storage = "10G"
@@ -46,38 +77,64 @@ resource "kubernetes_persistent_volume_claim" "cache-autoproj-import" {
     }
 }
 
-resource "kubernetes_persistent_volume" "cache-autoproj-import-rw" {
+resource "kubernetes_deployment" "cache-autoproj-import-server" {
     metadata {
-        name = "cache-autoproj-import-rw"
+        name = "cache-autoproj-import-server"
+        labels = {
+            app = "cache-autoproj-import"
+        }
     }
 
     spec {
-        capacity = {
-            storage = "10Gi"
+        replicas = 1
+
+        selector {
+            match_labels = {
+                app = "cache-autoproj-import"
+            }
         }
-        storage_class_name = "standard"
-        access_modes = ["ReadWriteOnce"]
-        persistent_volume_source {
-            gce_persistent_disk {
-                pd_name = google_compute_disk.cache-autoproj-import.name
+
+        template {
+            metadata {
+                labels = {
+                    app = "cache-autoproj-import"
+                }
+                namespace = "default"
             }
 
-        }
-    }
-}
+            spec {
+                security_context {
+                    fs_group = 2000
+                }
 
-resource "kubernetes_persistent_volume_claim" "cache-autoproj-import-rw" {
-    metadata {
-        name = "cache-autoproj-import-rw"
-    }
+                container {
+                    name = "cache-autoproj-import-server"
+                    image = "gcr.io/${var.project}/volume-nfs"
+                    image_pull_policy = "Always"
 
-    spec {
-        access_modes = ["ReadWriteOnce"]
-        resources {
-            requests = {
-                storage = "10G"
+                    resources {
+                        requests {
+                            cpu = "0"
+                        }
+                    }
+
+                    security_context {
+                        privileged = true
+                    }
+
+                    volume_mount {
+                        name = "cache-autoproj-import"
+                        # MUST BE /exports, see cache-autoproj-build.tf
+                        mount_path = "/exports"
+                    }
+                }
+                volume {
+                    name = "cache-autoproj-import"
+                    gce_persistent_disk {
+                        pd_name = google_compute_disk.cache-autoproj-import.name
+                    }
+                }
             }
         }
-        volume_name = kubernetes_persistent_volume.cache-autoproj-import-rw.metadata.0.name
     }
 }
@@ -0,0 +1,35 @@
+# Used by the test-shards script. The shards run `autoproj ci test` in the
+# same workspace at the same time, and would otherwise all write their test
+# report in the same file. This makes each shard write it where
+# AUTOPROJ_TEST_SHARD_REPORT points to instead. The path the report should
+# have been written to is saved next to it, in .target, for the merge
+#
+# Autoproj has no API to change where a utility writes its report, so this
+# relies on PhaseReporting's internals: its constructor's first two
+# arguments are the phase name and the report path, which create_report
+# reads from @name and @path. The override checks that this is still the
+# case, and fails the shard otherwise instead of letting the shards overwrite
+# each other's report. tests/test_test_shards.py runs it
+if (shard_report = ENV['AUTOPROJ_TEST_SHARD_REPORT'])
+    phase_reporting = Autoproj::Ops::PhaseReporting
+    arguments = phase_reporting.instance_method(:initialize).parameters.map(&:last)
+    unless arguments[0, 2] == %i[name path] &&
+           phase_reporting.method_defined?(:create_report)
+        raise "99-test-shard-report.rb: unsupported Autoproj::Ops::PhaseReporting "\
+              "in autoproj #{Autoproj::VERSION}"
+    end
+
+    phase_reporting.prepend(Module.new do
+        define_method(:create_report) do |*args, **kw|
+            if instance_variable_get(:@name).to_s == 'test'
+                unless instance_variable_defined?(:@path)
+                    raise "99-test-shard-report.rb: PhaseReporting has no @path "\
+                          "in autoproj #{Autoproj::VERSION}"
+                end
+                File.write("#{shard_report}.target", instance_variable_get(:@path))
+                instance_variable_set(:@path, shard_report)
+            end
+            super(*args, **kw)
+        end
+    end)
+end
@@ -0,0 +1,145 @@
+import os
+import sys
+import gzip
+import shutil
+import hashlib
+import secrets
+
+# Default path of the chunk store, relative to the master's basedir
+CHUNK_STORE_DIR = 'build_artifacts/chunks'
+
+# Suffix of the manifests, next to where the artifacts tarball would be
+MANIFEST_SUFFIX = '.chunks'
+
+READ_SIZE = 64 * 1024
+
+# The artifacts of a build are stored as a manifest that lists the chunks of
+# the artifacts tarball, one '<sha256> <size>' line per chunk, in order. The
+# chunks themselves are stored gzip-compressed in the store, under the sha256
+# of their uncompressed content. The chunking is done on the worker by the
+# artifact-chunks script
+
+def chunk_path(store_dir, digest):
+    return os.path.join(store_dir, digest[:2], f"{digest}.gz")
+
+def read_manifest(path):
+    """Return the list of (digest, size) of a manifest"""
+
+    chunks = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            digest, size, *_ = line.split()
+            chunks.append((digest, int(size)))
+    return chunks
+
+def missing_chunks(store_dir, manifest):
+    """Return the digests of the chunks of the manifest that the store does
+    not have, without duplicates and in manifest order
+    """
+
+    missing = {}
+    for digest, _ in manifest:
+        if digest not in missing and not os.path.isfile(chunk_path(store_dir, digest)):
+            missing[digest] = True
+    return list(missing)
+
+def chunk_digest(path):
+    hasher = hashlib.sha256()
+    with gzip.open(path, 'rb') as file:
+        for block in iter(lambda: file.read(READ_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def add_chunks(store_dir, upload_dir):
+    """Move the chunks uploaded in upload_dir to the store
+
+    The uploaded chunks are named '<sha256>.gz'. Chunks whose content does
+    not match their name are ignored. Returns the number of chunks added
+    """
+
+    if not os.path.isdir(upload_dir):
+        return 0
+
+    added = 0
+    for name in os.listdir(upload_dir):
+        if not name.endswith(".gz"):
+            continue
+
+        digest = name[:-3]
+        source = os.path.join(upload_dir, name)
+        try:
+            if chunk_digest(source) != digest:
+                continue
+        except (OSError, EOFError):
+            continue
+
+        target = chunk_path(store_dir, digest)
+        if os.path.isfile(target):
+            continue
+
+        # Rename through a temporary name, so that concurrent builds never
+        # see a partial chunk
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.tmp-{secrets.token_hex(8)}"
+        shutil.move(source, tmp)
+        os.rename(tmp, target)
+        added += 1
+    return added
+
+def stream_artifacts(store_dir, manifest):
+    """Generator that yields the content of the artifacts tarball described
+    by a manifest, one block at a time
+    """
+
+    for digest, _ in manifest:
+        with gzip.open(chunk_path(store_dir, digest), 'rb') as file:
+            yield from iter(lambda: file.read(READ_SIZE), b"")
+
+def artifacts_size(manifest):
+    return sum(size for _, size in manifest)
+
+def gc(store_dir, manifest_dir):
+    """Delete the chunks that are not listed in any manifest of manifest_dir
+
+    Returns the number of chunks deleted
+    """
+
+    used = set()
+    for name in os.listdir(manifest_dir):
+        if name.endswith(MANIFEST_SUFFIX):
+            used.update(digest for digest, _ in
+                        read_manifest(os.path.join(manifest_dir, name)))
+
+    deleted = 0
+    for prefix in os.listdir(store_dir):
+        prefix_dir = os.path.join(store_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+
+        for name in os.listdir(prefix_dir):
+            if name.endswith(".gz") and name[:-3] not in used:
+                os.remove(os.path.join(prefix_dir, name))
+                deleted += 1
+    return deleted
+
+def main(argv):
+    usage = ("usage: chunkstore.py cat MANIFEST [STORE_DIR]\n"
+             "       chunkstore.py gc MANIFEST_DIR [STORE_DIR]")
+    if len(argv) not in (2, 3) or argv[0] not in ('cat', 'gc'):
+        print(usage, file=sys.stderr)
+        return 1
+
+    command, path = argv[:2]
+    store_dir = argv[2] if len(argv) == 3 else CHUNK_STORE_DIR
+    if command == 'cat':
+        for block in stream_artifacts(store_dir, read_manifest(path)):
+            sys.stdout.buffer.write(block)
+    else:
+        print(f"deleted {gc(store_dir, path)} unused chunks")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
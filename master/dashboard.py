@@ -1,11 +1,38 @@
+import io
 import os
 import json
-
+import gzip
+import codecs
+import itertools
+import threading
+
+from collections import OrderedDict, deque
+from fnmatch import fnmatchcase
+from stat import S_ISREG
 from flask import Flask
+from flask import Response
+from flask import abort
+from flask import jsonify
 from flask import render_template
+from flask import request
+from flask import stream_template
+from flask import stream_with_context
+from flask import url_for
 from pathlib import Path
 
+from buildbot import config
 from buildbot.process.results import statusToString
+from buildbot.util import service
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+
+import chunkstore
+import history
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 STATUS_ORDER = {
     'import failed': 0,
@@ -20,96 +47,641 @@ STATUS_ORDER = {
     'unknown': 9
 }
 
-def Create(name):
+# Suffixes of the files that may hold a given log, in order of preference
+COMPRESSED_SUFFIXES = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Name and format version of the per-report index generated by
+# write_dashboard_index
+DASHBOARD_INDEX_NAME = 'dashboard-index.json'
+DASHBOARD_INDEX_VERSION = 1
+
+# Name of the file, in the report directory, that holds the duration of each
+# build phase
+TIMINGS_NAME = 'timings.json'
+
+class ReportCache:
+    """Bounded LRU cache of processed build reports
+
+    Entries are keyed by the report name and invalidated when the mtime or
+    size of the underlying report.json changes. Reports are immutable once
+    extracted, so this mostly saves re-parsing them on every page load.
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, reports_name, stat):
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(reports_name)
+            if entry is not None and entry[0] == key:
+                self._entries.move_to_end(reports_name)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            return None
+
+    def put(self, reports_name, stat, report):
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            self._entries[reports_name] = (key, report)
+            self._entries.move_to_end(reports_name)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+report_cache = ReportCache()
+
+class DashboardView:
+    """Materialized list of the builds shown on the dashboard
+
+    It is filled and kept up to date by DashboardViewService, so that
+    requests do not have to query the data API. Until the service populated
+    it, the dashboard falls back to querying the data API on each request.
+    """
+
+    def __init__(self, build_count=30):
+        self.build_count = build_count
+        self.ready = False
+        self._builds = []
+        self._toplevel_builds = {}
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            return (self._builds, self._toplevel_builds)
+
+    def replace(self, build_info):
+        self._update(build_info)
+        self.ready = True
+
+    def add(self, build_info):
+        with self._lock:
+            builds = self._builds
+        self._update(build_info + builds)
+
+    def _update(self, build_info):
+        by_id = { build['id']: build for build in build_info }
+        builds = sorted(by_id.values(), key=lambda b: -b['id'])
+        builds = builds[:self.build_count]
+        toplevel_builds = compute_toplevel_builds(builds)
+        with self._lock:
+            self._builds = builds
+            self._toplevel_builds = toplevel_builds
+
+class MasterDataAPI:
+    """Blocking access to the master's data API from a non-reactor thread
+
+    This provides the same dataGet interface than the wsgi dashboards plugin
+    """
+
+    def __init__(self, master):
+        self.master = master
+
+    def dataGet(self, path, **kwargs):
+        if isinstance(path, str):
+            path = tuple(path.strip('/').split('/'))
+        return threads.blockingCallFromThread(
+            reactor, self.master.data.get, path, **kwargs)
+
+class DashboardViewService(service.BuildbotService):
+    """Keeps a DashboardView up to date from Buildbot's build events
+
+    The view is fully computed at startup, and then updated with each
+    finished build. Add it to the master's services with the same view
+    that has been given to Create
+    """
+
+    name = 'autoproj-dashboard-view'
+
+    def checkConfig(self, view, page_size=100, max_pages=10):
+        if not isinstance(view, DashboardView):
+            config.error("DashboardViewService expects a DashboardView")
+
+    @defer.inlineCallbacks
+    def reconfigService(self, view, page_size=100, max_pages=10):
+        self.view = view
+        self.page_size = page_size
+        self.max_pages = max_pages
+        if self.running:
+            yield self.refresh()
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        self.consumer = yield self.master.mq.startConsuming(
+            self.buildFinished, ('builds', None, 'finished'))
+        if getattr(self, 'view', None) is not None:
+            yield self.refresh()
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self.consumer.stopConsuming()
+        yield super().stopService()
+
+    @defer.inlineCallbacks
+    def refresh(self):
+        build_info = yield threads.deferToThread(
+            fetch_build_info, MasterDataAPI(self.master),
+            build_count=self.view.build_count,
+            page_size=self.page_size, max_pages=self.max_pages)
+        self.view.replace(build_info)
+
+    @defer.inlineCallbacks
+    def buildFinished(self, key, build):
+        if build['results'] is None or build['results'] > 2:
+            return
+
+        try:
+            builder = yield self.master.data.get(('builders', build['builderid']))
+            if builder is None:
+                return
+
+            build_info = yield threads.deferToThread(
+                compute_build_info, [build], [builder])
+            self.view.add(build_info)
+        except Exception:
+            log.err(None, f"failed to add build {build['buildid']} to the dashboard")
+
+def Create(name, report_cache_size=64, build_count=30, page_size=100,
+           max_pages=10, fetch_properties=False,
+           history_db=history.HISTORY_DB_PATH, view=None):
     app = Flask(name, root_path=os.path.dirname(__file__))
     # this allows to work on the template without having to restart Buildbot
     app.config['TEMPLATES_AUTO_RELOAD'] = True
-    app.add_url_rule("/index.html", "index", lambda: dashboard(app))
+    report_cache.resize(report_cache_size)
+    fetch_options = {
+        'build_count': build_count,
+        'page_size': page_size,
+        'max_pages': max_pages,
+        'fetch_properties': fetch_properties
+    }
+    app.add_url_rule("/index.html", "index",
+                     lambda: dashboard(app, view, **fetch_options))
+    app.add_url_rule("/api/builds.json", "api_builds",
+                     lambda: api_builds(app, view, **fetch_options))
+    app.add_url_rule("/api/builds/<reports_name>/packages.json",
+                     "api_build_packages", api_build_packages)
     app.add_url_rule("/logs/<reports_name>/<path:packagename>/<logtype>", "log_get", log_get)
     app.add_url_rule("/test-results/<reports_name>/<path:packagename>", "test_results_get", test_results_get)
+    app.add_url_rule("/report-cache.json", "report_cache_stats", report_cache_stats)
+    app.add_url_rule("/artifacts/<reports_name>.tar", "artifacts_get", artifacts_get)
+    app.add_url_rule("/history.html", "history",
+                     lambda: history_page(history_db))
+    app.add_url_rule("/api/history/flaky.json", "api_history_flaky",
+                     lambda: api_history_flaky(history_db))
+    app.add_url_rule("/api/history/builders.json", "api_history_builders",
+                     lambda: api_history_builders(history_db))
+    app.add_url_rule("/api/history/first-failure.json", "api_history_first_failure",
+                     lambda: api_history_first_failure(history_db))
+    app.add_url_rule("/api/history/phases.json", "api_history_phases",
+                     lambda: api_history_phases(history_db))
+    app.add_template_filter(format_duration, 'duration')
     return app
 
 
-def dashboard(app):
-    # This code fetches build data from the data api, and give it to the
-    # template
-    builders = app.buildbot_api.dataGet("/builders")
+def dashboard(app, view=None, **fetch_options):
+    # Package details are loaded by the page itself through
+    # api_build_packages
+    build_info, toplevel_builds = current_build_info(app, view, **fetch_options)
+    return render_template('dashboard.html', builds=build_info, toplevel_builds=toplevel_builds)
+
+def api_builds(app, view=None, **fetch_options):
+    build_info, _ = current_build_info(app, view, **fetch_options)
+    return jsonify([build_info_to_json(build) for build in build_info])
+
+def api_build_packages(reports_name):
+    build_reports = Path("build_reports").resolve(strict=True)
+    # Make sure our arguments are not trying to get us out of build_reports/
+    # This raises if `path` does not start with `build_reports`
+    try:
+        (build_reports / reports_name).resolve().relative_to(build_reports)
+    except ValueError:
+        abort(404)
+
+    report = package_info_for(reports_name)
+    if report is None:
+        abort(404)
+
+    return jsonify([package_to_json(reports_name, pkg)
+                    for pkg in report['packages']])
+
+def build_info_to_json(build):
+    return {
+        'id': build['id'],
+        'name': build['name'],
+        'reports_name': build['reports_name'],
+        'builder_id': build['builder_id'],
+        'build_number': build['build_number'],
+        'builder_name': build['builder_name'],
+        'state': build['state'],
+        'summary': build['summary'],
+        'timings': build['timings'],
+        'packages_url': url_for('api_build_packages',
+                                reports_name=build['reports_name'])
+    }
+
+def package_to_json(reports_name, pkg):
+    logs = {
+        log_type: url_for('log_get', reports_name=reports_name,
+                          packagename=pkg['name'], logtype=log_type)
+        for log_type in pkg['logs']
+    }
+    tests = [
+        {
+            'type': result['type'],
+            'url': url_for('test_results_get', reports_name=reports_name,
+                           packagename=pkg['name'])
+        }
+        for result in pkg['tests']
+    ]
+    return {
+        'name': pkg['name'],
+        'status': pkg['status'],
+        'logs': logs,
+        'tests': tests
+    }
+
+def history_page(history_db):
+    package = request.args.get('package')
+    first_failures = None
+    if package:
+        first_failures = history.first_failing_builds(history_db, package)
+
+    return render_template('history.html',
+        flaky=history.flaky_packages(history_db),
+        builders=history.builder_success_rates(history_db),
+        phase_trends=history.phase_duration_trends(history_db),
+        phases=history.BUILD_PHASES,
+        package=package, first_failures=first_failures)
+
+def api_history_flaky(history_db):
+    return jsonify(history.flaky_packages(
+        history_db,
+        window=request.args.get('window', 20, type=int),
+        min_flips=request.args.get('min_flips', 2, type=int),
+        limit=request.args.get('limit', 50, type=int)))
+
+def api_history_builders(history_db):
+    return jsonify(history.builder_success_rates(
+        history_db, window=request.args.get('window', 50, type=int)))
+
+def api_history_phases(history_db):
+    return jsonify(history.phase_duration_trends(
+        history_db, window=request.args.get('window', 20, type=int)))
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    elif seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02}s"
+    else:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02}m"
+
+def api_history_first_failure(history_db):
+    package = request.args.get('package')
+    if not package:
+        abort(400)
+    return jsonify(history.first_failing_builds(history_db, package))
+
+def current_build_info(app, view, **fetch_options):
+    if view is not None and view.ready:
+        return view.get()
+
+    # This code fetches build data from the data api
+    build_info = fetch_build_info(app.buildbot_api, **fetch_options)
+    return (build_info, compute_toplevel_builds(build_info))
+
+def fetch_build_info(api, build_count=30, page_size=100, max_pages=10,
+                     fetch_properties=False):
+    builders = index_builders(api.dataGet("/builders"))
 
-    offset = 0
     build_info = []
-    while len(build_info) < 30:
-        builds = app.buildbot_api.dataGet("/builds", limit=5, offset=offset, order=["-buildid"])
-        builds = [b for b in builds if b['results'] != None and b['results'] <= 2]
+    for page in range(max_pages):
+        builds = api.dataGet(
+            "/builds", limit=page_size, offset=page * page_size,
+            order=["-buildid"])
+        finished = [b for b in builds
+                    if b['results'] is not None and b['results'] <= 2]
+        # Filter out builds without reports before doing any further API call
+        finished = [b for b in finished if has_report(b, builders)]
+
+        # properties are not used in the template, but this is how you get
+        # more properties
+        if fetch_properties:
+            for build in finished:
+                build['properties'] = api.dataGet(
+                    ("builds", build['buildid'], "properties"))
+
+        build_info.extend(compute_build_info(finished, builders))
+        if len(build_info) >= build_count or len(builds) < page_size:
+            break
+
+    return build_info[:build_count]
+
+def index_builders(builders):
+    return { builder['builderid']: builder for builder in builders }
+
+def build_names(build, builders):
+    builder = builders.get(build['builderid'])
+    if builder is None:
+        return None
+
+    buildername = builder.get(
+        'virtual_builder_name',
+        builder.get('name')
+    )
+    name = f"{buildername}-{build['number']}"
+    return (buildername, name, name.replace('/', ':'))
+
+def has_report(build, builders):
+    names = build_names(build, builders)
+    return names is not None and Path(f"build_reports/{names[2]}").is_dir()
+
+def report_cache_stats():
+    return jsonify(report_cache.stats())
+
+def resolve_report_file(reports_name, relpath):
+    """Find a file in a report directory, possibly compressed
+
+    Returns the resolved path and the compression it uses (one of the keys
+    of COMPRESSED_SUFFIXES), or aborts with 404 if none exist
+    """
 
-        # properties are actually not used in the template example, but this is
-        # how you get more properties
-        for build in builds:
-            build['properties'] = app.buildbot_api.dataGet(
-                ("builds", build['buildid'], "properties"))
+    build_reports = Path("build_reports").resolve(strict=True)
+    for encoding, suffix in COMPRESSED_SUFFIXES.items():
+        if encoding == 'zstd' and zstandard is None:
+            continue
+
+        path = build_reports / reports_name / f"{relpath}{suffix}"
+        try:
+            path = path.resolve(strict=True)
+        except OSError:
+            continue
+
+        # Make sure our arguments are not trying to get us out of build_reports/
+        # This raises if `path` does not start with `build_reports`
+        try:
+            path.relative_to(build_reports)
+        except ValueError:
+            abort(404)
+        if path.is_file():
+            return (path, encoding)
+
+    abort(404)
+
+def strip_compressed_suffix(name):
+    for suffix in COMPRESSED_SUFFIXES.values():
+        if suffix and name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def open_report_file(path, encoding):
+    if encoding == 'gzip':
+        return gzip.open(path, 'rb')
+    elif encoding == 'zstd':
+        # The zstandard reader is not line-iterable by itself
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), closefd=True))
+    else:
+        return open(path, 'rb')
+
+def read_chunks(file, size=None):
+    while size is None or size > 0:
+        chunk_size = STREAM_CHUNK_SIZE
+        if size is not None:
+            chunk_size = min(size, chunk_size)
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        if size is not None:
+            size -= len(chunk)
+        yield chunk
+
+def skip_bytes(file, count, compressed):
+    if compressed:
+        for _ in read_chunks(file, count):
+            pass
+    else:
+        file.seek(count)
 
-        new_info = compute_build_info(builds, builders)
-        offset += 5
-        build_info.extend(new_info)
+def tail_lines(file, count, compressed):
+    # Seeking backwards in compressed streams means decompressing from the
+    # start again. Do a single pass instead, keeping only the last lines
+    if compressed:
+        yield from deque(file, maxlen=count)
+        return
 
-    toplevel_builds = compute_toplevel_builds(build_info)
-    return render_template('dashboard.html', builds=build_info, toplevel_builds=toplevel_builds)
+    # Walk backwards from the end of the file until we found enough lines
+    start = file.seek(0, os.SEEK_END)
+    newlines = 0
+    while start > 0 and newlines <= count:
+        step = min(STREAM_CHUNK_SIZE, start)
+        start -= step
+        file.seek(start)
+        newlines += file.read(step).count(b"\n")
+
+    file.seek(start)
+    yield from deque(file, maxlen=count)
+
+def stream_whole_file(path, encoding):
+    with open_report_file(path, encoding) as file:
+        yield from read_chunks(file)
+
+def parse_range(spec):
+    try:
+        first, last = spec.split('-', 1)
+        first = int(first) if first else 0
+        last = int(last) if last else None
+    except ValueError:
+        abort(400)
+
+    if first < 0 or (last is not None and last < first):
+        abort(400)
+    return (first, last)
+
+def stream_report_file(path, encoding, args):
+    """Generator that yields the part of a report file selected by args
+
+    The supported arguments are head=N and tail=N (number of lines),
+    lines=FIRST-LAST (0-based line range, inclusive) and bytes=FIRST-LAST
+    (0-based byte range, inclusive). The file is read in chunks, and is
+    never loaded in memory as a whole.
+    """
+
+    head = args.get('head', type=int)
+    tail = args.get('tail', type=int)
+    lines = args.get('lines')
+    byte_range = args.get('bytes')
+
+    # Validate before we start streaming, so that errors are reported
+    if (head is not None and head < 0) or (tail is not None and tail < 0):
+        abort(400)
+    if lines is not None:
+        lines = parse_range(lines)
+    if byte_range is not None:
+        byte_range = parse_range(byte_range)
+
+    compressed = encoding is not None
+
+    def generate():
+        with open_report_file(path, encoding) as file:
+            if head is not None:
+                yield from itertools.islice(file, head)
+            elif tail is not None:
+                yield from tail_lines(file, tail, compressed)
+            elif lines is not None:
+                first, last = lines
+                stop = None if last is None else last + 1
+                yield from itertools.islice(file, first, stop)
+            elif byte_range is not None:
+                first, last = byte_range
+                skip_bytes(file, first, compressed)
+                size = None if last is None else last - first + 1
+                yield from read_chunks(file, size)
+            else:
+                yield from read_chunks(file)
+
+    return generate()
+
+def decode_chunks(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+def accepted_content_encoding(encoding):
+    """Whether the client accepts the given compression as a Content-Encoding"""
+    return encoding is not None and encoding in request.accept_encodings
+
+def send_compressed_file(path, encoding, mimetype):
+    """Pass the compressed bytes of a file through to the client"""
+
+    def generate():
+        with open(path, 'rb') as file:
+            yield from read_chunks(file)
+
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Content-Length'] = str(path.stat().st_size)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 def test_results_get(reports_name, packagename):
-    build_reports = Path("build_reports").resolve(strict=True)
-    path = build_reports / reports_name / 'logs' / 'test-results' / f"{packagename}.html"
-    path = path.resolve(strict=True)
-    # Make sure our arguments are not trying to get us out of build_reports/
-    # This raises if `path` does not start with `build_reports`
-    path.relative_to(build_reports)
+    path, encoding = resolve_report_file(
+        reports_name, f"logs/test-results/{packagename}.html")
+    if accepted_content_encoding(encoding):
+        return send_compressed_file(path, encoding, 'text/html')
 
-    contents = path.read_text();
-    return contents
-    #contents = path.read_text();
-    #return render_template('tests.html', contents=contents)
+    return Response(stream_with_context(stream_whole_file(path, encoding)),
+                    mimetype='text/html')
 
 def log_get(reports_name, packagename, logtype):
-    build_reports = Path("build_reports").resolve(strict=True)
-    path = build_reports / reports_name / 'logs' / f"{packagename}-{logtype}.log"
-    path = path.resolve(strict=True)
-    # Make sure our arguments are not trying to get us out of build_reports/
-    # This raises if `path` does not start with `build_reports`
-    path.relative_to(build_reports)
+    path, encoding = resolve_report_file(
+        reports_name, f"logs/{packagename}-{logtype}.log")
+
+    raw = request.args.get('raw', type=int)
+    paged = any(arg in request.args for arg in ('head', 'tail', 'lines', 'bytes'))
+    if raw and not paged and accepted_content_encoding(encoding):
+        return send_compressed_file(path, encoding, 'text/plain')
 
-    log_contents = path.read_text()
-    return render_template('log.html',
+    chunks = stream_report_file(path, encoding, request.args)
+    if raw:
+        return Response(stream_with_context(chunks), mimetype='text/plain')
+
+    return Response(stream_template('log.html',
         reports_name=reports_name, packagename=packagename,
-        logtype=logtype, log_contents=log_contents)
+        logtype=logtype, log_chunks=decode_chunks(chunks)))
+
+def artifacts_get(reports_name):
+    """Stream the artifacts tarball of a build from the chunk store"""
+
+    build_artifacts = Path("build_artifacts").resolve(strict=True)
+    path = (build_artifacts / f"{reports_name}{chunkstore.MANIFEST_SUFFIX}").resolve()
+    # Make sure our arguments are not trying to get us out of build_artifacts/
+    # This raises if `path` does not start with `build_artifacts`
+    try:
+        path.relative_to(build_artifacts)
+    except ValueError:
+        abort(404)
+    if not path.is_file():
+        abort(404)
+
+    manifest = chunkstore.read_manifest(path)
+    chunks = chunkstore.stream_artifacts(chunkstore.CHUNK_STORE_DIR, manifest)
+    return Response(stream_with_context(chunks), mimetype='application/x-tar',
+        headers={
+            'Content-Length': str(chunkstore.artifacts_size(manifest)),
+            'Content-Disposition': f'attachment; filename="{reports_name}.tar"'
+        })
 
 def compute_build_info(builds, builders):
+    if not isinstance(builders, dict):
+        builders = index_builders(builders)
+
     info = []
     for build in builds:
-        for builder in builders:
-            if build['builderid'] == builder['builderid']:
-                buildername = builder.get(
-                    'virtual_builder_name',
-                    builder.get('name')
-                )
-                name = f"{buildername}-{build['number']}"
-                reports_name = name.replace('/', ':')
-
-                report = package_info_for(reports_name)
-                if not report is None:
-                    summary = build_summary(report)
-                    build_info = {
-                        'id': build['buildid'],
-                        'name': name,
-                        'reports_name': reports_name,
-                        'builder_id': build['builderid'],
-                        'build_number': build['number'],
-                        'builder_name': buildername,
-                        'summary': summary,
-                        'report': report
-                    }
-                    build_info['state'] = compute_build_state(build_info)
-                    info.append(build_info)
+        names = build_names(build, builders)
+        if names is None:
+            continue
+
+        buildername, name, reports_name = names
+        report = package_info_for(reports_name)
+        if not report is None:
+            summary = report['summary']
+            build_info = {
+                'id': build['buildid'],
+                'name': name,
+                'reports_name': reports_name,
+                'builder_id': build['builderid'],
+                'build_number': build['number'],
+                'builder_name': buildername,
+                'summary': summary,
+                'timings': load_timings(reports_name),
+                'report': report
+            }
+            build_info['state'] = compute_build_state(build_info)
+            info.append(build_info)
 
     return info
 
+def load_timings(reports_name):
+    try:
+        with open(Path('build_reports', reports_name, TIMINGS_NAME)) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
 def compute_build_state(summary):
     package_info = summary['report']['packages']
     if package_info:
@@ -132,25 +704,143 @@ def compute_toplevel_builds(build_info):
 def package_info_for(reports_name):
     basedir = Path(f'build_reports/{reports_name}')
     report_path = basedir / 'report.json'
-    if not report_path.is_file():
+    try:
+        stat = report_path.stat()
+    except OSError:
         return
+    if not S_ISREG(stat.st_mode):
+        return
+
+    info = report_cache.get(reports_name, stat)
+    if info is None:
+        info = load_package_info(basedir, report_path)
+        report_cache.put(reports_name, stat, info)
 
+    return info
+
+def load_package_info(basedir, report_path):
     with open(report_path) as f:
         info = json.loads(f.read())
 
+    index = load_dashboard_index(basedir)
+
     packages = []
     for pkg_name in info['packages']:
         pkg = info['packages'][pkg_name]
         pkg['name'] = pkg_name
-        pkg['status'] = compute_package_status(pkg)
-        pkg['logs'] = compute_package_logs(pkg, basedir)
-        pkg['tests'] = compute_package_tests(pkg, basedir)
+        if index is not None and pkg_name in index['packages']:
+            indexed = index['packages'][pkg_name]
+            pkg['status'] = indexed['status']
+            pkg['logs'] = {
+                log_type: package_log_path(pkg, basedir, log_type)
+                for log_type in indexed['logs']
+            }
+            pkg['tests'] = [
+                { 'path': basedir / test['path'], 'type': test['type'] }
+                for test in indexed['tests']
+            ]
+        else:
+            pkg['status'] = compute_package_status(pkg)
+            pkg['logs'] = compute_package_logs(pkg, basedir)
+            pkg['tests'] = compute_package_tests(pkg, basedir)
         packages.append(pkg)
 
     packages.sort(key=lambda pkg: [STATUS_ORDER[pkg['status'][0]['text']], pkg['name']])
     info['packages'] = packages
+    info['summary'] = build_summary(info)
     return info
 
+def load_dashboard_index(basedir):
+    """Load the index written by write_dashboard_index
+
+    Returns None if there is none, or if it has been generated by an
+    incompatible version of this code
+    """
+
+    try:
+        with open(basedir / DASHBOARD_INDEX_NAME) as f:
+            index = json.loads(f.read())
+    except (OSError, ValueError):
+        return
+
+    if index.get('version') != DASHBOARD_INDEX_VERSION:
+        return
+    return index
+
+def write_dashboard_index(basedir):
+    """Compute the package logs, tests and status of a report and save them
+
+    This is meant to be called once, when the report gets extracted on the
+    master. It lists the whole log directory in one pass, instead of once per
+    package.
+
+    Returns False if the directory has no report.json, True otherwise
+    """
+
+    report_path = basedir / 'report.json'
+    if not report_path.is_file():
+        return False
+
+    with open(report_path) as f:
+        info = json.loads(f.read())
+
+    log_files = list_log_files(basedir)
+    packages = {}
+    for pkg_name in info['packages']:
+        pkg = info['packages'][pkg_name]
+        pkg['name'] = pkg_name
+        packages[pkg_name] = {
+            'status': compute_package_status(pkg),
+            'logs': index_package_logs(pkg, log_files),
+            'tests': index_package_tests(pkg, log_files)
+        }
+
+    index = { 'version': DASHBOARD_INDEX_VERSION, 'packages': packages }
+    index_path = basedir / DASHBOARD_INDEX_NAME
+    tmp_path = basedir / f"{DASHBOARD_INDEX_NAME}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(index))
+    os.replace(tmp_path, index_path)
+    return True
+
+def list_log_files(basedir):
+    """Return the files in the log directory, grouped by subdirectory
+
+    The keys are tuples of the subdirectory path elements, relative to
+    the log directory
+    """
+
+    logdir = basedir / 'logs'
+    files = {}
+    for dirpath, _, filenames in os.walk(logdir):
+        relative = Path(dirpath).relative_to(logdir)
+        files[relative.parts] = filenames
+    return files
+
+def index_package_logs(pkg, log_files):
+    pkg_elements = pkg['name'].split('/')
+    basename = pkg_elements.pop()
+
+    logs = []
+    slice_start = len(basename) + 1
+    for name in log_files.get(tuple(pkg_elements), []):
+        name = strip_compressed_suffix(name)
+        if fnmatchcase(name, f"{basename}-*.log"):
+            logs.append(name[slice_start:-4])
+    return sorted(logs)
+
+def index_package_tests(pkg, log_files):
+    pkg_elements = pkg['name'].split('/')
+    basename = pkg_elements.pop()
+
+    xunit_html = f"{basename}.html"
+    names = log_files.get(('test-results', *pkg_elements), [])
+    if xunit_html in (strip_compressed_suffix(name) for name in names):
+        path = Path('logs', 'test-results', *pkg_elements, xunit_html)
+        return [{ 'path': str(path), 'type': 'xunit' }]
+
+    return []
+
 def build_summary(report):
     results = {}
     for pkg in report['packages']:
@@ -164,7 +854,7 @@ def build_summary(report):
                     'count': 1
                 }
 
-    return results.values()
+    return list(results.values())
 
 def status_order(status):
     return min(STATUS_ORDER[s['text']] for s in status)
@@ -194,6 +884,11 @@ def compute_package_status(pkg):
     return status
 
 
+def package_log_path(pkg, basedir, log_type):
+    pkg_elements = pkg['name'].split('/')
+    basename = pkg_elements.pop()
+    return basedir.joinpath('logs', *pkg_elements, f"{basename}-{log_type}.log")
+
 def compute_package_logs(pkg, basedir):
     logs = {}
     pkg_elements = pkg['name'].split('/')
@@ -204,9 +899,9 @@ def compute_package_logs(pkg, basedir):
 
     slice_start = len(basename) + 1
     for path in logdir.iterdir():
-        if path.is_file() and path.match(f"{basename}-*.log"):
-            slice_end = len(path.name) - 4
-            log_type = path.name[slice_start:slice_end]
+        name = strip_compressed_suffix(path.name)
+        if path.is_file() and fnmatchcase(name, f"{basename}-*.log"):
+            log_type = name[slice_start:-4]
             logs[log_type] = path
 
     return logs
@@ -216,7 +911,8 @@ def compute_package_tests(pkg, basedir):
     pkg_elements = pkg['name'].split('/')
     basename = pkg_elements.pop()
     xunit_html = basedir.joinpath('logs', 'test-results', *pkg_elements, f"{basename}.html")
-    if xunit_html.is_file():
-        return [{ 'path': xunit_html, 'type': 'xunit' }]
+    for suffix in COMPRESSED_SUFFIXES.values():
+        if Path(f"{xunit_html}{suffix}").is_file():
+            return [{ 'path': xunit_html, 'type': 'xunit' }]
 
     return []
@@ -0,0 +1,379 @@
+import time
+import sqlite3
+
+from contextlib import closing
+
+# Default path of the history database, relative to the master's basedir
+HISTORY_DB_PATH = 'build_history.sqlite'
+
+# Phases of a package in the build report
+PACKAGE_PHASES = ['import', 'build', 'test']
+
+# Phases of a build, in order
+BUILD_PHASES = ['bootstrap', 'update', 'build', 'test', 'report', 'artifacts']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    reports_name TEXT NOT NULL UNIQUE,
+    builder_name TEXT NOT NULL,
+    build_number INTEGER NOT NULL,
+    ingested_at REAL NOT NULL,
+    real_builder_name TEXT
+);
+CREATE INDEX IF NOT EXISTS builds_by_builder
+    ON builds (builder_name, build_number);
+
+CREATE TABLE IF NOT EXISTS package_results (
+    build_id INTEGER NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    package TEXT NOT NULL,
+    status TEXT NOT NULL,
+    success INTEGER,
+    import_success INTEGER,
+    import_cached INTEGER,
+    build_success INTEGER,
+    build_cached INTEGER,
+    test_success INTEGER,
+    test_cached INTEGER,
+    PRIMARY KEY (build_id, package)
+);
+CREATE INDEX IF NOT EXISTS package_results_by_package
+    ON package_results (package, build_id);
+
+CREATE TABLE IF NOT EXISTS resource_usage (
+    build_id INTEGER PRIMARY KEY REFERENCES builds (id) ON DELETE CASCADE,
+    peak_cpu REAL NOT NULL,
+    peak_memory_bytes INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS test_durations (
+    build_id INTEGER NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    package TEXT NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (build_id, package)
+);
+
+CREATE TABLE IF NOT EXISTS phase_durations (
+    build_id INTEGER NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (build_id, phase)
+);
+"""
+
+# Columns added to the tables of SCHEMA after their creation, added to the
+# existing databases by connect()
+ADDED_COLUMNS = [
+    ('builds', 'real_builder_name', 'TEXT')
+]
+
+# Indexes on the ADDED_COLUMNS
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS builds_by_real_builder
+    ON builds (real_builder_name, build_number);
+"""
+
+def connect(db_path=HISTORY_DB_PATH):
+    """Open the history database, creating the schema if needed"""
+
+    db = sqlite3.connect(db_path, timeout=30)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA foreign_keys = ON")
+    db.executescript(SCHEMA)
+    for table, column, column_type in ADDED_COLUMNS:
+        columns = [row['name'] for row in db.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    db.executescript(ADDED_INDEXES)
+    return db
+
+def phase_columns(pkg):
+    columns = {}
+    for phase in PACKAGE_PHASES:
+        info = pkg.get(phase)
+        if info and info.get('invoked'):
+            columns[f"{phase}_success"] = int(bool(info.get('success')))
+            columns[f"{phase}_cached"] = int(bool(info.get('cached')))
+        else:
+            columns[f"{phase}_success"] = None
+            columns[f"{phase}_cached"] = None
+    return columns
+
+def main_phase_success(columns):
+    for phase in reversed(PACKAGE_PHASES):
+        success = columns[f"{phase}_success"]
+        if success is not None:
+            return success
+
+def ensure_build(db, reports_name, builder_name, build_number,
+                 real_builder_name=None):
+    """Return the ID of a build, creating it if needed
+
+    builder_name is the name the build is displayed under (the virtual
+    builder name, if any), real_builder_name the name of its Buildbot
+    builder. The latter is shared by the builds of all PRs and branches
+    """
+
+    row = db.execute("SELECT id FROM builds WHERE reports_name = ?",
+                     (reports_name,)).fetchone()
+    if row is not None:
+        if real_builder_name is not None:
+            db.execute("UPDATE builds SET real_builder_name = ? WHERE id = ?",
+                       (real_builder_name, row['id']))
+        return row['id']
+
+    cursor = db.execute(
+        "INSERT INTO builds (reports_name, builder_name, build_number, ingested_at, "
+        "real_builder_name) VALUES (?, ?, ?, ?, ?)",
+        (reports_name, builder_name, build_number, time.time(), real_builder_name))
+    return cursor.lastrowid
+
+def ingest_report(db_path, reports_name, builder_name, build_number, report):
+    """Store the package results of a processed build report
+
+    `report` is the report as returned by dashboard.package_info_for.
+    Ingesting the same report twice replaces the previous results.
+    """
+
+    with closing(connect(db_path)) as db, db:
+        build_id = ensure_build(db, reports_name, builder_name, build_number)
+        db.execute("DELETE FROM package_results WHERE build_id = ?", (build_id,))
+
+        rows = []
+        for pkg in report['packages']:
+            columns = phase_columns(pkg)
+            rows.append((
+                build_id, pkg['name'], pkg['status'][0]['text'],
+                main_phase_success(columns),
+                columns['import_success'], columns['import_cached'],
+                columns['build_success'], columns['build_cached'],
+                columns['test_success'], columns['test_cached']
+            ))
+
+        db.executemany(
+            "INSERT INTO package_results (build_id, package, status, success, "
+            "import_success, import_cached, build_success, build_cached, "
+            "test_success, test_cached) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows)
+
+def flaky_packages(db_path, window=20, min_flips=2, limit=50):
+    """Packages whose result flips between success and failure
+
+    Only the last `window` builds of each builder are considered. Returns
+    the packages with at least `min_flips` transitions, most flaky first
+    """
+
+    query = """
+    WITH recent AS (
+        SELECT id, builder_name, build_number,
+               ROW_NUMBER() OVER (PARTITION BY builder_name
+                                  ORDER BY build_number DESC) AS age
+        FROM builds
+        WHERE id IN (SELECT build_id FROM package_results)
+    ),
+    results AS (
+        SELECT r.package, b.builder_name, b.build_number, r.success,
+               LAG(r.success) OVER (PARTITION BY b.builder_name, r.package
+                                    ORDER BY b.build_number) AS previous
+        FROM package_results r
+        JOIN recent b ON b.id = r.build_id
+        WHERE b.age <= ? AND r.success IS NOT NULL
+    )
+    SELECT package, builder_name, COUNT(*) AS flips,
+           MAX(build_number) AS last_flip
+    FROM results
+    WHERE previous IS NOT NULL AND previous != success
+    GROUP BY package, builder_name
+    HAVING flips >= ?
+    ORDER BY flips DESC, package
+    LIMIT ?
+    """
+    with closing(connect(db_path)) as db:
+        return [dict(row) for row in db.execute(query, (window, min_flips, limit))]
+
+def first_failing_builds(db_path, package):
+    """First build of the current failure streak of a package, per builder
+
+    Builders on which the package's last result is a success are not listed
+    """
+
+    query = """
+    WITH results AS (
+        SELECT b.builder_name, b.build_number, b.reports_name, r.success
+        FROM package_results r
+        JOIN builds b ON b.id = r.build_id
+        WHERE r.package = ? AND r.success IS NOT NULL
+    ),
+    last_success AS (
+        SELECT builder_name, MAX(build_number) AS build_number
+        FROM results WHERE success = 1
+        GROUP BY builder_name
+    )
+    SELECT f.builder_name, f.build_number, f.reports_name
+    FROM results f
+    LEFT JOIN last_success s ON s.builder_name = f.builder_name
+    WHERE f.success = 0
+      AND (s.build_number IS NULL OR f.build_number > s.build_number)
+      AND f.build_number = (
+          SELECT MIN(o.build_number) FROM results o
+          WHERE o.builder_name = f.builder_name AND o.success = 0
+            AND (s.build_number IS NULL OR o.build_number > s.build_number))
+    ORDER BY f.builder_name
+    """
+    with closing(connect(db_path)) as db:
+        return [dict(row) for row in db.execute(query, (package,))]
+
+def builder_success_rates(db_path, window=50):
+    """Fraction of the last `window` builds of each builder without failures"""
+
+    query = """
+    WITH recent AS (
+        SELECT id, builder_name,
+               ROW_NUMBER() OVER (PARTITION BY builder_name
+                                  ORDER BY build_number DESC) AS age
+        FROM builds
+        WHERE id IN (SELECT build_id FROM package_results)
+    ),
+    per_build AS (
+        SELECT b.builder_name, MIN(COALESCE(r.success, 1)) AS success
+        FROM recent b
+        JOIN package_results r ON r.build_id = b.id
+        WHERE b.age <= ?
+        GROUP BY b.id
+    )
+    SELECT builder_name, COUNT(*) AS builds, SUM(success) AS successes,
+           AVG(success) AS success_rate
+    FROM per_build
+    GROUP BY builder_name
+    ORDER BY builder_name
+    """
+    with closing(connect(db_path)) as db:
+        return [dict(row) for row in db.execute(query, (window,))]
+
+def record_phase_durations(db_path, reports_name, builder_name, build_number,
+                           durations):
+    """Store the duration of each phase of a build, in seconds
+
+    Recording the durations of the same build twice replaces the previous ones
+    """
+
+    with closing(connect(db_path)) as db, db:
+        build_id = ensure_build(db, reports_name, builder_name, build_number)
+        db.execute("DELETE FROM phase_durations WHERE build_id = ?", (build_id,))
+        db.executemany(
+            "INSERT INTO phase_durations (build_id, phase, duration) VALUES (?, ?, ?)",
+            [(build_id, phase, duration) for phase, duration in durations.items()])
+
+def phase_duration_trends(db_path, window=20):
+    """Phase durations of the last `window` builds of each builder
+
+    Returns a dictionary from builder name to a list of builds, newest first.
+    Each build is a dictionary with the build number and a `phases`
+    dictionary from phase name to duration in seconds
+    """
+
+    query = """
+    WITH recent AS (
+        SELECT id, builder_name, build_number,
+               ROW_NUMBER() OVER (PARTITION BY builder_name
+                                  ORDER BY build_number DESC) AS age
+        FROM builds
+        WHERE id IN (SELECT build_id FROM phase_durations)
+    )
+    SELECT b.builder_name, b.build_number, d.phase, d.duration
+    FROM recent b
+    JOIN phase_durations d ON d.build_id = b.id
+    WHERE b.age <= ?
+    ORDER BY b.builder_name, b.build_number DESC
+    """
+
+    trends = {}
+    with closing(connect(db_path)) as db:
+        for row in db.execute(query, (window,)):
+            builds = trends.setdefault(row['builder_name'], [])
+            if not builds or builds[-1]['build_number'] != row['build_number']:
+                builds.append({ 'build_number': row['build_number'], 'phases': {} })
+            builds[-1]['phases'][row['phase']] = row['duration']
+    return trends
+
+def record_resource_usage(db_path, reports_name, builder_name, build_number,
+                          peak_cpu, peak_memory_bytes, real_builder_name=None):
+    """Store the peak CPU (in cores) and memory usage of a build"""
+
+    with closing(connect(db_path)) as db, db:
+        build_id = ensure_build(db, reports_name, builder_name, build_number,
+                                real_builder_name)
+        db.execute(
+            "INSERT OR REPLACE INTO resource_usage (build_id, peak_cpu, peak_memory_bytes) "
+            "VALUES (?, ?, ?)",
+            (build_id, peak_cpu, peak_memory_bytes))
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def resource_usage_percentile(db_path, real_builder_name, window=20, fraction=0.9):
+    """Percentile of the peak CPU and memory usage over the last builds
+
+    The builds are the ones of the given Buildbot builder, whichever PR or
+    branch they built. Returns (peak_cpu, peak_memory_bytes), or None if no
+    build of this builder recorded its resource usage
+    """
+
+    query = """
+    SELECT u.peak_cpu, u.peak_memory_bytes
+    FROM resource_usage u
+    JOIN builds b ON b.id = u.build_id
+    WHERE b.real_builder_name = ?
+    ORDER BY b.build_number DESC
+    LIMIT ?
+    """
+    with closing(connect(db_path)) as db:
+        rows = db.execute(query, (real_builder_name, window)).fetchall()
+
+    if not rows:
+        return None
+    return (percentile([row['peak_cpu'] for row in rows], fraction),
+            percentile([row['peak_memory_bytes'] for row in rows], fraction))
+
+def record_test_durations(db_path, reports_name, builder_name, build_number,
+                          durations, real_builder_name=None):
+    """Store the duration of the tests of each package of a build, in seconds
+
+    Recording the durations of the same build twice replaces the previous ones
+    """
+
+    with closing(connect(db_path)) as db, db:
+        build_id = ensure_build(db, reports_name, builder_name, build_number,
+                                real_builder_name)
+        db.execute("DELETE FROM test_durations WHERE build_id = ?", (build_id,))
+        db.executemany(
+            "INSERT INTO test_durations (build_id, package, duration) VALUES (?, ?, ?)",
+            [(build_id, package, duration) for package, duration in durations.items()])
+
+def test_duration_estimates(db_path, real_builder_name, window=10):
+    """Average test duration of each package over the last builds of a builder
+
+    The builds are the ones of the given Buildbot builder, whichever PR or
+    branch they built. Only the last `window` builds that recorded test
+    durations are considered. Returns a dictionary from package name to
+    duration in seconds
+    """
+
+    query = """
+    WITH recent AS (
+        SELECT id FROM builds
+        WHERE real_builder_name = ?
+          AND id IN (SELECT build_id FROM test_durations)
+        ORDER BY build_number DESC
+        LIMIT ?
+    )
+    SELECT package, AVG(duration) AS duration
+    FROM test_durations
+    WHERE build_id IN (SELECT id FROM recent)
+    GROUP BY package
+    """
+    with closing(connect(db_path)) as db:
+        return { row['package']: row['duration']
+                 for row in db.execute(query, (real_builder_name, window)) }
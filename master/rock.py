@@ -1,7 +1,31 @@
+from buildbot import config
 from buildbot.plugins import *
-from twisted.internet import defer
-
+from buildbot.data import resultspec
+from buildbot.process import buildrequest, buildstep
+from buildbot.steps.transfer import makeStatusRemoteCommand
+from buildbot.util import unicode2bytes
+from buildbot.worker.protocols import base
+from buildbot.process import properties
+from buildbot.util import service
+from twisted.internet import defer, task, threads
+from twisted.python import log
+from datetime import datetime
+from pathlib import Path
+
+import os
+import re
+import json
+import math
+import random
+import time
 import uuid
+import shutil
+import tempfile
+import subprocess
+import yaml
+import chunkstore
+import dashboard
+import history
 
 AUTOPROJ_GIT_URL  = "https://github.com/rock-core/autoproj"
 AUTOBUILD_GIT_URL = "https://github.com/rock-core/autobuild"
@@ -9,10 +33,88 @@ AUTOPROJ_CI_GIT_URL = "https://github.com/rock-core/autoproj-ci"
 
 CACHE_IMPORT_DIR = "/var/cache/autoproj/import"
 cache_import_lock = util.MasterLock("cache-import", maxCount=512)
+# Serializes the import cache updates when using import cache generations,
+# which do not need to lock the builds out
+cache_import_update_lock = util.MasterLock("cache-import-update")
+# Where builds find the import cache generation they pinned
+IMPORT_CACHE_PIN = "/buildbot/import-cache"
+IMPORT_CACHE_GENERATION_SCRIPT = "/buildbot/import-cache-generation"
+# Precompiled gems, shared by all the import cache updates. It is on the
+# import cache volume, outside of the import cache generations
+GEM_STORE_DIR = f"{CACHE_IMPORT_DIR}/gem-store"
+GEM_COMPILE_STORE_SCRIPT = "/buildbot/gem-compile-store"
+
+def importCacheGemfileLock(cache_dir, buildconf_url):
+    """Where the import cache updates of a build configuration save the
+    Gemfile.lock of their workspace
+
+    The builds key their bootstrap snapshots on it (see Bootstrap), which
+    gives them the released versions of autoproj, autobuild and autoproj-ci
+    without asking rubygems
+    """
+
+    name = re.sub(r'[^\w.-]', '_', buildconf_url)
+    return util.Interpolate(f"%(kw:cache_dir)s/gemfile-locks/{name}.lock",
+                            cache_dir=cache_dir)
 
 CACHE_BUILD_BASE_DIR = '/var/cache/autoproj/build'
 CACHE_BUILD_DIR = util.Interpolate(f"{CACHE_BUILD_BASE_DIR}/%(prop:build_cache_key:-%(prop:buildername)s)s")
 
+# Where the bootstrap snapshots are stored. This is on the build cache
+# volume, which is shared by all build workers
+BOOTSTRAP_SNAPSHOT_DIR = f"{CACHE_BUILD_BASE_DIR}/bootstrap"
+# Node-local tier of the build cache, see BuildWorker and Build
+CACHE_BUILD_LOCAL_BASE_DIR = '/var/cache/autoproj/build-local'
+CACHE_BUILD_LOCAL_DIR = util.Interpolate(f"{CACHE_BUILD_LOCAL_BASE_DIR}/%(prop:build_cache_key:-%(prop:buildername)s)s")
+
+# Compression backends for the report and artifacts tarballs
+#
+# 'program' is the compressor as given to tar's --use-compress-program on the
+# worker, 'command' compresses a file in place on the worker and 'decompress'
+# is the decompressor used on the master. The multi-threaded backends use
+# parallel_build_level threads.
+COMPRESSION_BACKENDS = {
+    'bzip2': {
+        'suffix': 'bz2',
+        'program': 'bzip2',
+        'command': ['bzip2'],
+        'decompress': 'bzip2 -d'
+    },
+    'gzip': {
+        'suffix': 'gz',
+        'program': 'gzip',
+        'command': ['gzip'],
+        'decompress': 'gzip -d'
+    },
+    'pigz': {
+        'suffix': 'gz',
+        'program': util.Interpolate('pigz -p %(prop:parallel_build_level:-1)s'),
+        'command': ['pigz', '-p', util.Interpolate('%(prop:parallel_build_level:-1)s')],
+        'decompress': 'gzip -d'
+    },
+    'zstd': {
+        'suffix': 'zst',
+        'program': util.Interpolate('zstd -T%(prop:parallel_build_level:-1)s'),
+        'command': ['zstd', '-q', '--rm', util.Interpolate('-T%(prop:parallel_build_level:-1)s')],
+        'decompress': 'zstd -d'
+    }
+}
+
+# Compression of the report stream when using StreamingDirectoryUpload, which
+# relies on the worker's builtin (python) tar support
+STREAM_COMPRESSION = {
+    'bzip2': ('bz2', 'tar.bz2'),
+    'gzip': ('gz', 'tar.gz'),
+    'none': (None, 'tar')
+}
+
+def compressionBackend(name):
+    try:
+        return COMPRESSION_BACKENDS[name]
+    except KeyError:
+        config.error(f"unknown compression backend '{name}', "
+                     f"known backends are {', '.join(COMPRESSION_BACKENDS)}")
+
 class BaseWorker(worker.KubeLatentWorker):
     @defer.inlineCallbacks
     def getPodSpec(self, build):
@@ -23,7 +125,53 @@ class BaseWorker(worker.KubeLatentWorker):
         }
         return pod_def
 
+    @defer.inlineCallbacks
+    def isCompatibleWithBuild(self, build_props):
+        compatible = yield super().isCompatibleWithBuild(build_props)
+        if not compatible:
+            # The pod gets recreated for the build. If this happens to warm
+            # pods, WarmPodPool does not render them as the builds would
+            log.msg(f"worker {self.name}: running pod is not compatible with a "
+                    f"build of {build_props.getProperty('buildername')}, it will "
+                    "be replaced")
+        return compatible
+
+def adaptiveResources(build, usage, max_cpu, memory_per_process_M):
+    """Compute the pod resources from the observed peak usage of a builder
+
+    The CPU request is the observed peak rounded up, between
+    min_parallel_build_level and max_cpu. It also becomes the build's
+    parallel level. The memory request is the observed peak plus 20%, between
+    memory_per_process_M for each CPU and for max_cpu CPUs. The latter is also
+    the memory limit.
+    """
+
+    peak_cpu, peak_memory_bytes = usage
+    min_cpu = build.getProperty('min_parallel_build_level', 1)
+    cpu = max(min_cpu, min(max_cpu, math.ceil(peak_cpu)))
+
+    memory_M = int(peak_memory_bytes * 1.2 / 1024 / 1024)
+    max_memory_M = memory_per_process_M * max_cpu
+    memory_M = max(memory_per_process_M * cpu, min(max_memory_M, memory_M))
+
+    build.setProperty('parallel_build_level', cpu, 'AdaptiveResources', runtime=True)
+    return {
+        'requests': {
+            'cpu': cpu,
+            'memory': f"{memory_M}Mi"
+        },
+        'limits': {
+            'memory': f"{max_memory_M}Mi"
+        }
+    }
+
 class ImportCacheWorker(BaseWorker):
+    """Worker for the import cache updates
+
+    The pod requests one CPU per parallel gem compilation, as set by the
+    gem_compile_jobs property
+    """
+
     @defer.inlineCallbacks
     def getPodSpec(self, build):
         pod_def = yield super().getPodSpec(build)
@@ -32,13 +180,13 @@ class ImportCacheWorker(BaseWorker):
         container = spec['containers'][0]
         container['resources'] = {
             'requests': {
-                'cpu': 1,
+                'cpu': build.getProperty('gem_compile_jobs', 1),
                 'memory': f"1G"
             }
         }
         container['volumeMounts'] = [
             {
-                'name': 'cache-autoproj-import-rw',
+                'name': 'cache-autoproj-import',
                 'mountPath': '/var/cache/autoproj/import'
             }
         ]
@@ -48,9 +196,9 @@ class ImportCacheWorker(BaseWorker):
         }]
         spec['volumes'] = [
             {
-                'name': 'cache-autoproj-import-rw',
+                'name': 'cache-autoproj-import',
                 'persistentVolumeClaim': {
-                    'claimName': 'cache-autoproj-import-rw'
+                    'claimName': 'cache-autoproj-import'
                 }
             }
         ]
@@ -78,21 +226,49 @@ class BuildCacheWorker(BaseWorker):
         return pod_def
 
 class BuildWorker(BaseWorker):
+    """Worker for the builds themselves
+
+    The pod requests parallel_build_level CPUs and memory_per_build_process_G
+    of memory per CPU. If the adaptive_resources property is set, the
+    requests and the build's parallel level are instead derived from the peak
+    usage of the builder's last builds (see resource_usage_percentile),
+    bounded by min_parallel_build_level and parallel_build_level.
+
+    If the local_build_cache property is set, it is a path on the node that
+    is mounted as the local tier of the build cache (see Build)
+    """
+
     @defer.inlineCallbacks
     def getPodSpec(self, build):
         pod_def = yield super().getPodSpec(build)
         spec = pod_def['spec']
 
         cpu = build.getProperty('parallel_build_level', 1)
-        memory_k = int(build.getProperty('memory_per_build_process_G', 1.5) * 1024)
-
-        container = spec['containers'][0]
-        container['resources'] = {
+        memory_per_process_M = int(build.getProperty('memory_per_build_process_G', 1.5) * 1024)
+        resources = {
             'requests': {
                 'cpu': cpu,
-                'memory': f"{memory_k * cpu}k"
+                'memory': f"{memory_per_process_M * cpu}Mi"
             }
         }
+
+        # `build` is a Properties object when Buildbot checks whether a
+        # running pod is compatible with a build, and for warm pods (see
+        # WarmPodPool). They take the same path as the builds, so that the
+        # spec matches the one of the pods started for the builder. The
+        # history is the builder's, not the PR's or branch's
+        builder_name = build.getProperty('buildername')
+        if builder_name and build.getProperty('adaptive_resources', False):
+            usage = yield threads.deferToThread(
+                history.resource_usage_percentile,
+                history.HISTORY_DB_PATH, builder_name,
+                window=build.getProperty('adaptive_resources_window', 20),
+                fraction=build.getProperty('adaptive_resources_percentile', 0.9))
+            if usage is not None:
+                resources = adaptiveResources(build, usage, cpu, memory_per_process_M)
+
+        container = spec['containers'][0]
+        container['resources'] = resources
         container['volumeMounts'] = [
             {
                 'name': 'cache-autoproj-import',
@@ -122,12 +298,248 @@ class BuildWorker(BaseWorker):
                 'persistentVolumeClaim': { 'claimName': 'cache-autoproj-build' }
             }
         ]
+
+        local_build_cache = build.getProperty('local_build_cache')
+        if local_build_cache:
+            container['volumeMounts'].append({
+                'name': 'cache-autoproj-build-local',
+                'mountPath': CACHE_BUILD_LOCAL_BASE_DIR
+            })
+            spec['volumes'].append({
+                'name': 'cache-autoproj-build-local',
+                'hostPath': {
+                    'path': local_build_cache,
+                    'type': 'DirectoryOrCreate'
+                }
+            })
         return pod_def
 
 
-def Barrier(factory, name):
-    factory.addStep(
-        steps.SetProperty(property=f"{name}BarrierReached", value=True, hideStepIf=True)
+def workerPool(worker_class, name, size, **kwargs):
+    """Create `size` workers of the given class, named NAME-0 to NAME-N-1
+
+    Each latent worker runs at most one pod. A pool of them is what allows
+    WarmPodPool to keep idle pods around
+    """
+
+    return [worker_class(f"{name}-{i}", **kwargs) for i in range(size)]
+
+def preferWarmWorkers(builder, workers, buildrequest):
+    """nextWorker function that picks workers with a running pod first
+
+    Workers that are not latent workers have no pod, and are never preferred
+    """
+
+    warm = [wfb for wfb in workers if getattr(wfb.worker, 'substantiated', False)]
+    return random.choice(warm or workers) if workers else None
+
+class WarmPodPool(service.BuildbotService):
+    """Keep pre-provisioned idle pods for a pool of latent workers
+
+    Every `check_interval` seconds, the service starts pods for idle workers
+    of `worker_names` until `warm_count` of them are up and not building.
+    Pods that stayed idle for more than `idle_ttl` seconds are stopped, and
+    replaced at the next check if they are still needed.
+
+    Warm pods are created before their build is known. They are rendered
+    with the properties of `builder_name` (the builder's name and the
+    properties of its configuration), as the builds of this builder would
+    be, so that Buildbot finds them compatible with these builds. Builders
+    should use preferWarmWorkers as nextWorker so that builds go to the warm
+    pods first.
+    """
+
+    def checkConfig(self, worker_names, warm_count, builder_name,
+                    idle_ttl=600, check_interval=30):
+        if warm_count > len(worker_names):
+            config.error(f"WarmPodPool {self.name}: cannot keep {warm_count} warm pods "
+                         f"with {len(worker_names)} workers")
+
+    @defer.inlineCallbacks
+    def reconfigService(self, worker_names, warm_count, builder_name,
+                        idle_ttl=600, check_interval=30):
+        self.worker_names = worker_names
+        self.warm_count = warm_count
+        self.builder_name = builder_name
+        self.idle_ttl = idle_ttl
+        self.warm_since = {}
+        self.starting = set()
+
+        if getattr(self, 'loop', None) is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = task.LoopingCall(self.check)
+        self.check_interval = check_interval
+        if self.running:
+            self.loop.start(self.check_interval, now=False)
+        yield super().reconfigService()
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        self.loop.start(self.check_interval, now=False)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        if self.loop.running:
+            self.loop.stop()
+        yield super().stopService()
+
+    def workers(self):
+        registered = self.master.workers.workers
+        return [registered[name] for name in self.worker_names if name in registered]
+
+    def podProperties(self):
+        """The properties the builds of builder_name start with
+
+        This is what Buildbot renders the pod spec with when checking
+        whether a running pod is compatible with a build (see
+        Builder.setup_properties)
+        """
+
+        builders = {b.name: b for b in self.master.config.builders}
+        builder = builders.get(self.builder_name)
+        if builder is None:
+            log.msg(f"WarmPodPool {self.name}: no builder named {self.builder_name}")
+            return None
+
+        props = properties.Properties()
+        props.setProperty('buildername', builder.name, 'Builder')
+        props.update(builder.properties or {}, 'Builder')
+        for name, value in (getattr(builder, 'defaultProperties', None) or {}).items():
+            if name not in props:
+                props.setProperty(name, value, 'Builder')
+        return props
+
+    def check(self):
+        now = time.time()
+        idle = []
+        cold = []
+        for worker in self.workers():
+            if worker.building:
+                self.warm_since.pop(worker.name, None)
+            elif worker.substantiated:
+                idle.append(worker)
+            elif worker.conn is None and worker.name not in self.starting:
+                cold.append(worker)
+
+        for worker in list(idle):
+            since = self.warm_since.setdefault(worker.name, now)
+            if now - since > self.idle_ttl:
+                log.msg(f"WarmPodPool {self.name}: stopping idle worker {worker.name}")
+                self.warm_since.pop(worker.name)
+                d = worker.insubstantiate()
+                d.addErrback(log.err, f"while stopping warm worker {worker.name}")
+                idle.remove(worker)
+
+        to_start = cold[:max(0, self.warm_count - len(idle) - len(self.starting))]
+        props = self.podProperties() if to_start else None
+        if props is None:
+            return
+        for worker in to_start:
+            log.msg(f"WarmPodPool {self.name}: starting warm worker {worker.name}")
+            self.starting.add(worker.name)
+            d = worker.substantiate(None, props)
+            d.addErrback(log.err, f"while starting warm worker {worker.name}")
+            d.addBoth(lambda _, name=worker.name: self.starting.discard(name))
+
+@defer.inlineCallbacks
+def collapseByVirtualBuilder(master, builder, new_br, old_br):
+    """collapseRequests function that keeps only the newest request per PR
+
+    Requests that have the same virtual_builder_name (as set by the
+    autoproj-daemon scheduler) are collapsed into the newest one, regardless
+    of their revision, as long as Buildbot's default strategy would collapse
+    them and their buildset properties (e.g. rebuild or seed_config) match.
+    A request never collapses a newer one
+    """
+
+    if new_br['buildrequestid'] < old_br['buildrequestid']:
+        return False
+
+    collapsible = yield buildrequest.BuildRequest.canBeCollapsed(master, new_br, old_br)
+    if not collapsible:
+        return False
+
+    new_props = yield master.data.get(('buildsets', new_br['buildsetid'], 'properties'))
+    old_props = yield master.data.get(('buildsets', old_br['buildsetid'], 'properties'))
+    # This also compares virtual_builder_name
+    new_props = {k: v[0] for k, v in (new_props or {}).items() if k != 'scheduler'}
+    old_props = {k: v[0] for k, v in (old_props or {}).items() if k != 'scheduler'}
+    return new_props == old_props
+
+class SupersededBuildCanceller(service.BuildbotService):
+    """Stop the running builds that a new buildset supersedes
+
+    A running build is superseded when a newer buildset has the same
+    virtual_builder_name, i.e. a new revision of the same PR has been
+    pushed. Builds of the branches in `exempt_branches` are never stopped
+    """
+
+    name = 'autoproj-superseded-build-canceller'
+
+    def checkConfig(self, exempt_branches=['master']):
+        pass
+
+    @defer.inlineCallbacks
+    def reconfigService(self, exempt_branches=['master']):
+        self.exempt_branches = exempt_branches
+        yield super().reconfigService()
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        self.consumer = yield self.master.mq.startConsuming(
+            self.buildsetNew, ('buildsets', None, 'new'))
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self.consumer.stopConsuming()
+        yield super().stopService()
+
+    @defer.inlineCallbacks
+    def buildsetNew(self, key, buildset):
+        try:
+            yield self.cancelSuperseded(buildset['bsid'])
+        except Exception:
+            log.err(None, "while cancelling superseded builds")
+
+    @defer.inlineCallbacks
+    def cancelSuperseded(self, bsid):
+        props = yield self.master.data.get(('buildsets', bsid, 'properties'))
+        name = (props or {}).get('virtual_builder_name', (None,))[0]
+        if name is None:
+            return
+
+        builds = yield self.master.data.get(('builds',),
+            filters=[resultspec.Filter('complete', 'eq', [False])])
+        for build in builds:
+            request = yield self.master.data.get(('buildrequests', build['buildrequestid']))
+            if request is None or request['buildsetid'] >= bsid:
+                continue
+
+            build_props = yield self.master.data.get(
+                ('builds', build['buildid'], 'properties'))
+            if build_props.get('virtual_builder_name', (None,))[0] != name:
+                continue
+            if build_props.get('branch', (None,))[0] in self.exempt_branches:
+                continue
+
+            log.msg(f"stopping build {build['buildid']} of {name}, superseded by buildset {bsid}")
+            yield self.master.data.control('stop',
+                {'reason': f"superseded by a newer revision (buildset {bsid})"},
+                ('builds', build['buildid']))
+
+@util.renderer
+def currentTime(props):
+    return time.time()
+
+def Barrier(factory, name, **kwargs):
+    factory.addStep(steps.SetProperties(
+        properties={
+            f"{name}BarrierReached": True,
+            f"{name}BarrierTime": currentTime
+        },
+        hideStepIf=True, **kwargs)
     )
 
 def hasReachedBarrier(name):
@@ -146,7 +558,25 @@ def AutoprojStep(factory, *args, wrapper=[], name=None, ifReached=None, **kwargs
         command=[*wrapper, ".autoproj/bin/autoproj", *args],
         haltOnFailure=True, **barrierArgs, **kwargs))
 
-def Update(factory, osdeps=True, import_timeout=1200):
+OSDEPS_CACHE_DIR = f"{CACHE_BUILD_BASE_DIR}/osdeps"
+OSDEPS_CACHE_SCRIPT = "/buildbot/osdeps-cache"
+
+def Update(factory, osdeps=True, import_timeout=1200, osdeps_cache_window_h=None):
+    """Update the workspace and install its osdeps
+
+    If osdeps_cache_window_h is set, the apt lists and the set of debian
+    packages installed by the osdeps resolution are cached in
+    OSDEPS_CACHE_DIR (see the osdeps-cache script). The apt lists are
+    refreshed at most once per window of osdeps_cache_window_h hours, and
+    the cached packages are installed in one go before autoproj resolves the
+    osdeps, leaving it nothing to install. It requires the build cache volume
+    """
+
+    if osdeps and osdeps_cache_window_h is not None:
+        CachedOsdepsUpdate(factory, int(osdeps_cache_window_h * 3600),
+                           import_timeout=import_timeout)
+        return
+
     osdeps_update = []
     arguments = []
 
@@ -169,6 +599,42 @@ def Update(factory, osdeps=True, import_timeout=1200):
         timeout=import_timeout,
         haltOnFailure=True))
 
+def CachedOsdepsUpdate(factory, window, import_timeout=1200):
+    Barrier(factory, "update")
+    factory.addStep(steps.FileDownload(name="copy the osdeps cache script",
+        workerdest=OSDEPS_CACHE_SCRIPT,
+        mastersrc="osdeps-cache",
+        mode=0o755,
+        haltOnFailure=True))
+    factory.addStep(steps.SetPropertyFromCommand(
+        name="Restore or refresh the apt lists",
+        command=[OSDEPS_CACHE_SCRIPT, "lists", OSDEPS_CACHE_DIR, str(window)],
+        property="apt_lists_cache",
+        haltOnFailure=True))
+    factory.addStep(steps.ShellCommand(
+        name="Update",
+        command=[".autoproj/bin/autoproj", "update", "--no-osdeps",
+                 "--bundler=f", "--autoproj=f", "--interactive=f", "-k"],
+        timeout=import_timeout,
+        haltOnFailure=True))
+    factory.addStep(steps.SetPropertyFromCommand(
+        name="Install the cached osdeps",
+        command=[OSDEPS_CACHE_SCRIPT, "install", OSDEPS_CACHE_DIR, str(window)],
+        property="osdeps_cache",
+        flunkOnFailure=False,
+        warnOnFailure=True))
+    factory.addStep(steps.ShellCommand(
+        name="Install the osdeps",
+        command=[".autoproj/bin/autoproj", "osdeps", "--interactive=f"],
+        timeout=import_timeout,
+        haltOnFailure=True))
+    factory.addStep(steps.ShellCommand(
+        name="Save the installed osdeps",
+        command=[OSDEPS_CACHE_SCRIPT, "save", OSDEPS_CACHE_DIR, str(window)],
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=lambda step: step.getProperty("osdeps_cache") != "hit"))
+
 def CleanBuildCache(factory):
     factory.addStep(steps.ShellCommand(
         name="Clean the build cache",
@@ -177,12 +643,133 @@ def CleanBuildCache(factory):
         name="Check result",
         command=["find", util.Interpolate(f"{CACHE_BUILD_BASE_DIR}/%(prop:target_buildername)s")]))
 
-def UpdateImportCache(factory, gem_compile=["ffi"]):
+BUILD_CACHE_INDEX_SCRIPT = "/buildbot/build-cache-index"
+
+def MaintainBuildCache(factory, max_size_GB, policy="lru"):
+    """Evict entries from the build cache based on how they are accessed
+
+    The accesses are recorded by the builds (see the record_cache_access
+    argument of BuildReport). `policy` is either "lru" to evict the least
+    recently used entries first, or "lfu" to evict the entries with the
+    least cache hits first. The builders' caches and the bootstrap snapshots
+    share the `max_size_GB` budget, and are evicted from in a single order
+    """
+
+    if policy not in ("lru", "lfu"):
+        config.error(f"unknown build cache eviction policy {policy}, expected lru or lfu")
+
+    factory.addStep(steps.FileDownload(name="copy the build cache index script",
+        workerdest=BUILD_CACHE_INDEX_SCRIPT,
+        mastersrc="build-cache-index",
+        mode=0o755,
+        haltOnFailure=True))
+    factory.addStep(steps.ShellCommand(
+        name="Evict from the build cache",
+        command=[BUILD_CACHE_INDEX_SCRIPT, "evict", CACHE_BUILD_BASE_DIR,
+                 f"--max-size={max_size_GB}", f"--policy={policy}"],
+        haltOnFailure=True))
+
+def BuildCacheMaintenanceSetup(c, max_size_GB, policy="lru", period=3600,
+                               workers=["build-cache"]):
+    """Add a builder that periodically evicts entries from the build cache
+
+    This replaces the build_cache_max_size_GB argument of StandardSetup,
+    which cleans the cache at the beginning of each build
+    """
+
+    factory = util.BuildFactory()
+    MaintainBuildCache(factory, max_size_GB, policy=policy)
+
+    c['builders'].append(
+        util.BuilderConfig(name="build-cache-maintenance",
+            workernames=workers,
+            factory=factory))
+    c['schedulers'].append(
+        schedulers.Periodic(
+            name="build-cache-maintenance-periodic",
+            builderNames=["build-cache-maintenance"],
+            periodicBuildTimer=period))
+    c['schedulers'].append(
+        schedulers.ForceScheduler(
+            name="build-cache-maintenance-force",
+            builderNames=["build-cache-maintenance"]))
+
+class PinnedImportCacheGenerations(buildstep.BuildStep):
+    """Set the property 'pinned_import_cache_generations' to the list of
+    import cache generations pinned by the running builds
+    """
+
+    @defer.inlineCallbacks
+    def run(self):
+        builds = yield self.master.data.get(('builds',),
+            filters=[resultspec.Filter('complete', 'eq', [False])])
+
+        pinned = set()
+        for build in builds:
+            properties = yield self.master.data.get(
+                ('builds', build['buildid'], 'properties'))
+            generation = properties.get('import_cache_generation')
+            if generation is not None:
+                pinned.add(generation[0])
+
+        pinned = sorted(pinned)
+        self.setProperty('pinned_import_cache_generations', pinned,
+                         'PinnedImportCacheGenerations', runtime=True)
+        yield self.addCompleteLog('pinned', "\n".join(pinned))
+        return util.SUCCESS
+
+@util.renderer
+def importCacheGeneration(props):
+    """Name of the import cache generation created by an import cache update
+
+    The generations are shared by all the import cache builders, so the name
+    includes the builder's
+    """
+
+    builder_name = props.getProperty('buildername').replace('/', ':')
+    return f"{builder_name}-{props.getProperty('buildnumber')}"
+
+def UpdateImportCache(factory, gem_compile=["ffi"], generations=False,
+                      generations_keep=2, buildconf_url=None):
+    """Update the import cache
+
+    The gems listed in gem_compile are precompiled in parallel, using
+    gem_compile_jobs (a property) jobs. The compiled gems are kept in
+    GEM_STORE_DIR, keyed by their source gem, the ruby ABI and the platform,
+    so that a gem gets compiled only once for all the import cache updates.
+    Set the gems_compile_force property to recompile them anyway
+
+    If generations is set, the update is done in a new generation of the
+    import cache, which is swapped in once complete. Builds that started
+    before keep using the generation they pinned (see Bootstrap). Old
+    generations are deleted, except for the generations_keep most recently
+    created ones and the ones pinned by running builds
+
+    Generations are copied using hardlinks. This relies on git and the gem
+    cache replacing files rather than modifying them in place
+
+    If buildconf_url is given, the workspace's Gemfile.lock is saved in the
+    cache for the bootstrap snapshots of the builds of this configuration
+    (see importCacheGemfileLock)
+    """
+
     factory.addStep(steps.ShellCommand(
         name="Fix permissions on /var/cache/autoproj",
         command=["sudo", "chown", "buildbot", "-R", "/var/cache/autoproj"],
         haltOnFailure=True
     ))
+
+    cache_dir = CACHE_IMPORT_DIR
+    if generations:
+        generation = importCacheGeneration
+        cache_dir = util.Interpolate(f"{CACHE_IMPORT_DIR}/generations/%(kw:generation)s",
+                                     generation=generation)
+        factory.addStep(steps.ShellCommand(
+            name="Create a new import cache generation",
+            command=[IMPORT_CACHE_GENERATION_SCRIPT, "create", CACHE_IMPORT_DIR, generation],
+            haltOnFailure=True
+        ))
+
     factory.addStep(steps.ShellCommand(
         name="Install gem-compiler to cache the precompiled gems",
         command=[
@@ -196,13 +783,61 @@ def UpdateImportCache(factory, gem_compile=["ffi"]):
         name="Update the workspace's import cache",
         command=[
             ".autoproj/bin/autoproj", "cache", '--all=f',
-            CACHE_IMPORT_DIR, "--interactive=f", "-k",
-            "--gems",
-            util.Interpolate("--gems-compile-force=%(prop:gems_compile_force:#?|t|f)s"),
-            "--gems-compile", gem_compile
+            cache_dir, "--interactive=f", "-k",
+            "--gems"
         ],
         haltOnFailure=True
     ))
+    if gem_compile:
+        factory.addStep(steps.FileDownload(name="copy the gem compilation script",
+            workerdest=GEM_COMPILE_STORE_SCRIPT,
+            mastersrc="gem-compile-store",
+            mode=0o755,
+            haltOnFailure=True))
+        factory.addStep(steps.ShellCommand(
+            name="Precompile the gems",
+            command=[
+                ".autoproj/bin/bundle", "exec", GEM_COMPILE_STORE_SCRIPT, "compile",
+                util.Interpolate("%(kw:cache_dir)s/package_managers/gem", cache_dir=cache_dir),
+                GEM_STORE_DIR,
+                util.Interpolate("--jobs=%(prop:gem_compile_jobs:-1)s"),
+                util.Interpolate("--%(prop:gems_compile_force:#?||no-)sforce"),
+                *gem_compile
+            ],
+            env={'BUNDLE_GEMFILE': ".autoproj/Gemfile"},
+            haltOnFailure=True
+        ))
+
+    if buildconf_url is not None:
+        # Replace rather than overwrite, the file may be hardlinked in other
+        # generations
+        factory.addStep(steps.ShellCommand(
+            name="Save the workspace's Gemfile.lock in the import cache",
+            command=["sh", "-c",
+                     'mkdir -p "$(dirname "$1")" && cp .autoproj/Gemfile.lock "$1.tmp" && '
+                     'mv "$1.tmp" "$1"',
+                     "sh", importCacheGemfileLock(cache_dir, buildconf_url)],
+            haltOnFailure=True
+        ))
+
+    if generations:
+        factory.addStep(steps.ShellCommand(
+            name="Swap in the new import cache generation",
+            command=[IMPORT_CACHE_GENERATION_SCRIPT, "swap", CACHE_IMPORT_DIR, generation],
+            haltOnFailure=True
+        ))
+        factory.addStep(PinnedImportCacheGenerations(
+            name="List the import cache generations used by builds",
+            haltOnFailure=True))
+        factory.addStep(steps.ShellCommand(
+            name="Delete unused import cache generations",
+            command=util.Transform(
+                lambda pinned: [IMPORT_CACHE_GENERATION_SCRIPT, "gc", CACHE_IMPORT_DIR,
+                                str(generations_keep), *pinned],
+                util.Property('pinned_import_cache_generations', [])),
+            flunkOnFailure=False,
+            warnOnFailure=True
+        ))
 
 def GitCredentials(factory, url, credentials):
     """Register credentials to be used by git to access a given url
@@ -247,15 +882,49 @@ def Bootstrap(factory, buildconf_url,
               flavor="master",
               tests=True,
               build_cache_max_size_GB=None,
+              bootstrap_snapshot=False,
+              import_cache_generations=False,
               autoproj_url=AUTOPROJ_GIT_URL,
               autobuild_url=AUTOBUILD_GIT_URL,
               autoproj_ci_url=AUTOPROJ_CI_GIT_URL):
+    """Bootstrap the autoproj workspace
+
+    If bootstrap_snapshot is set, the bootstrapped workspace and gems are
+    saved in BOOTSTRAP_SNAPSHOT_DIR, keyed by everything that influences the
+    bootstrap (seed configs, Gemfile, autoproj, autobuild and autoproj-ci
+    sources, buildconf, ruby version). The released gem versions come from
+    the Gemfile.lock saved by the last import cache update of the same
+    buildconf (see importCacheGemfileLock). Builds with the
+    same key restore the snapshot instead of bootstrapping, and switch the
+    build configuration to their own branch. It requires the build cache
+    volume, and the snapshots are evicted by BuildCacheMaintenanceSetup.
+
+    If import_cache_generations is set, the build pins the current import
+    cache generation (see UpdateImportCache) in the import_cache_generation
+    property, and uses it for the whole build
+    """
 
     if autoproj_branch is None:
         bootstrap_script_url = "https://rock-robotics.org/autoproj_bootstrap"
     else:
         bootstrap_script_url = f"https://raw.githubusercontent.com/rock-core/autoproj/{autoproj_branch}/bin/autoproj_bootstrap"
 
+    Barrier(factory, "bootstrap")
+
+    importer_cache_dir = CACHE_IMPORT_DIR
+    if import_cache_generations:
+        importer_cache_dir = IMPORT_CACHE_PIN
+        factory.addStep(steps.FileDownload(name="copy the import cache generation script",
+            workerdest=IMPORT_CACHE_GENERATION_SCRIPT,
+            mastersrc="import-cache-generation",
+            mode=0o755,
+            haltOnFailure=True))
+        factory.addStep(steps.SetPropertyFromCommand(
+            name="Pin the import cache generation",
+            command=[IMPORT_CACHE_GENERATION_SCRIPT, "pin", CACHE_IMPORT_DIR, IMPORT_CACHE_PIN],
+            property="import_cache_generation",
+            haltOnFailure=True))
+
     if seed_config_path:
         factory.addStep(steps.FileDownload(
             name=f"copy user-provided seed config",
@@ -276,7 +945,7 @@ def Bootstrap(factory, buildconf_url,
 
     buildbot_seed_config = f"""
 import_log_enabled: false
-importer_cache_dir: "{CACHE_IMPORT_DIR}"
+importer_cache_dir: "{importer_cache_dir}"
 separate_prefixes: true
 ROCK_SELECTED_FLAVOR: {flavor}
     """
@@ -332,30 +1001,97 @@ ROCK_SELECTED_FLAVOR: {flavor}
 
     bundle_config = util.Interpolate(
         'echo "BUNDLE_JOBS: \"%(prop:parallel_build_level:-1)s\"" >> /home/buildbot/.bundle/config')
-    factory.addStep(steps.ShellSequence(
-        name="Bootstrap",
-        commands=[
-            util.ShellArg(command=["cp", "/var/lib/dpkg/status", "dpkg-status.orig"],
-                logfile="save the original dpkg status file", haltOnFailure=True),
-            util.ShellArg(command=["wget", bootstrap_script_url],
-                logfile="download", haltOnFailure=True),
-            util.ShellArg(command="mkdir -p /home/buildbot/.bundle", logfile="bundle-config",
-                haltOnFailure=True),
-            util.ShellArg(command=bundle_config, logfile="bundle-config",
-                haltOnFailure=True),
-            util.ShellArg(command=[
-                util.Interpolate("%(prop:ruby:-ruby)s"), "autoproj_bootstrap",
-                "--seed-config=user-seed-config.yml",
-                "--seed-config=build-properties-seed-config.yml",
-                "--seed-config=buildbot-seed-config.yml",
-                "--no-interactive", *bootstrap_options, vcstype, buildconf_url,
-                util.Interpolate(f"branch=%(prop:branch:-{buildconf_default_branch})s")],
-                logfile="bootstrap", haltOnFailure=True),
-            util.ShellArg(command=[
-                ".autoproj/bin/autoproj", "plugin", "install", "autoproj-ci", *autoproj_ci_args],
-                logfile="plugins", haltOnFailure=True)
-        ] + test_steps + cache_cleanup_steps,
-        haltOnFailure=True))
+    setup_steps=[
+        util.ShellArg(command=["cp", "/var/lib/dpkg/status", "dpkg-status.orig"],
+            logfile="save the original dpkg status file", haltOnFailure=True),
+        util.ShellArg(command="mkdir -p /home/buildbot/.bundle", logfile="bundle-config",
+            haltOnFailure=True),
+        util.ShellArg(command=bundle_config, logfile="bundle-config",
+            haltOnFailure=True)
+    ]
+    ruby = util.Interpolate("%(prop:ruby:-ruby)s")
+    buildconf_branch = util.Interpolate(f"branch=%(prop:branch:-{buildconf_default_branch})s")
+    bootstrap_steps=[
+        util.ShellArg(command=["wget", bootstrap_script_url],
+            logfile="download", haltOnFailure=True),
+        util.ShellArg(command=[
+            ruby, "autoproj_bootstrap",
+            "--seed-config=user-seed-config.yml",
+            "--seed-config=build-properties-seed-config.yml",
+            "--seed-config=buildbot-seed-config.yml",
+            "--no-interactive", *bootstrap_options, vcstype, buildconf_url,
+            buildconf_branch],
+            logfile="bootstrap", haltOnFailure=True),
+        util.ShellArg(command=[
+            ".autoproj/bin/autoproj", "plugin", "install", "autoproj-ci", *autoproj_ci_args],
+            logfile="plugins", haltOnFailure=True)
+    ]
+
+    if not bootstrap_snapshot:
+        factory.addStep(steps.ShellSequence(
+            name="Bootstrap",
+            commands=setup_steps + bootstrap_steps + test_steps + cache_cleanup_steps,
+            haltOnFailure=True))
+    else:
+        factory.addStep(steps.ShellSequence(
+            name="Prepare the bootstrap",
+            commands=setup_steps,
+            haltOnFailure=True))
+
+        snapshot_script = "/buildbot/bootstrap-snapshot"
+        factory.addStep(steps.FileDownload(name="copy the bootstrap snapshot script",
+            workerdest=snapshot_script,
+            mastersrc="bootstrap-snapshot",
+            mode=0o755,
+            haltOnFailure=True))
+
+        key_files = ["user-seed-config.yml", "build-properties-seed-config.yml",
+                     "buildbot-seed-config.yml", "Gemfile.buildbot",
+                     importCacheGemfileLock(importer_cache_dir, buildconf_url)]
+        # The branch of the build configuration is not part of the key, so
+        # that builds of different branches share the snapshots. The restored
+        # configuration is switched to the build's branch instead
+        key_values = [bootstrap_script_url, vcstype, buildconf_url,
+                      *bootstrap_options, *autoproj_ci_args]
+        factory.addStep(steps.SetPropertyFromCommand(
+            name="Compute the bootstrap snapshot key",
+            command=[snapshot_script, "key", "--ruby", ruby,
+                     *[arg for f in key_files for arg in ("--file", f)],
+                     *[arg for v in key_values for arg in ("--value", v)]],
+            property="bootstrap_snapshot_key",
+            haltOnFailure=True))
+        factory.addStep(steps.SetPropertyFromCommand(
+            name="Restore the bootstrap snapshot",
+            command=[snapshot_script, "restore", BOOTSTRAP_SNAPSHOT_DIR,
+                     util.Interpolate("%(prop:bootstrap_snapshot_key)s")],
+            property="bootstrap_snapshot",
+            haltOnFailure=True))
+
+        snapshotMissed = lambda step: step.getProperty("bootstrap_snapshot") != "hit"
+        factory.addStep(steps.ShellCommand(
+            name="Switch the build configuration to the build's branch",
+            command=[".autoproj/bin/autoproj", "switch-config", "--interactive=f",
+                     buildconf_branch],
+            haltOnFailure=True,
+            doStepIf=lambda step: not snapshotMissed(step)))
+        factory.addStep(steps.ShellSequence(
+            name="Bootstrap",
+            commands=bootstrap_steps,
+            haltOnFailure=True,
+            doStepIf=snapshotMissed))
+        factory.addStep(steps.ShellCommand(
+            name="Save the bootstrap snapshot",
+            command=[snapshot_script, "save", BOOTSTRAP_SNAPSHOT_DIR,
+                     util.Interpolate("%(prop:bootstrap_snapshot_key)s")],
+            flunkOnFailure=False,
+            warnOnFailure=True,
+            doStepIf=snapshotMissed))
+
+        if test_steps or cache_cleanup_steps:
+            factory.addStep(steps.ShellSequence(
+                name="Configure the workspace",
+                commands=test_steps + cache_cleanup_steps,
+                haltOnFailure=True))
 
     if overrides_file_paths:
         for file in overrides_file_paths:
@@ -365,13 +1101,558 @@ ROCK_SELECTED_FLAVOR: {flavor}
                 mastersrc=file,
                 haltOnFailure=True))
 
-def Build(factory, tests=True, test_utilities=['omniorb', 'x11'], build_timeout=1200):
-    p = util.Interpolate('-p%(prop:parallel_build_level:-1)s')
+RESOURCE_USAGE_SCRIPT = "/buildbot/resource-usage"
+RESOURCE_USAGE_SAMPLES = "resource-usage.txt"
+
+BUILD_CACHE_TIER_SCRIPT = "/buildbot/build-cache-tier"
+
+def installationManifestDependencies(manifest):
+    """Extract the package dependency graph from an autoproj installation manifest
 
+    Returns a dictionary from package name to the names of the packages it
+    depends on. Dependencies that are not packages of the manifest (e.g.
+    osdeps) are ignored
+    """
+
+    packages = {}
+    for entry in manifest or []:
+        if 'name' in entry and 'package_set' not in entry:
+            packages[entry['name']] = entry.get('dependencies') or []
+    return {
+        name: [dep for dep in deps if dep in packages]
+        for name, deps in packages.items()
+    }
+
+def planBuildShards(dependencies, shard_count, max_stages):
+    """Split the packages of a workspace in stages of independent shards
+
+    Packages are layered by dependency depth. The packages of a layer do not
+    depend on each other, so each layer is a stage whose packages are spread
+    over at most shard_count shards. If there are more than max_stages
+    layers, the adjacent stages with the least packages are merged until
+    there are max_stages of them. Within a merged stage, packages that depend
+    on each other are kept in the same shard. The shards of a stage may
+    therefore build in parallel, using the build cache to get the packages
+    of the previous stages.
+
+    Returns a list of stages, each being a list of shards, each being a
+    sorted list of package names
+    """
+
+    levels = {}
+    def level(name, visiting=frozenset()):
+        if name not in levels:
+            deps = [d for d in dependencies[name] if d not in visiting]
+            visiting = visiting | {name}
+            levels[name] = 1 + max((level(d, visiting) for d in deps), default=-1)
+        return levels[name]
+
+    layers = {}
+    for name in dependencies:
+        layers.setdefault(level(name), []).append(name)
+
+    # Merging the smallest stages costs the least parallelism. The tail of
+    # the dependency graph is usually narrow
+    stages = [layers[lvl] for lvl in sorted(layers)]
+    while len(stages) > max(max_stages, 1):
+        i = min(range(len(stages) - 1),
+                key=lambda i: len(stages[i]) + len(stages[i + 1]))
+        stages[i:i + 2] = [stages[i] + stages[i + 1]]
+
+    return [spreadBuildShard(dependencies, set(packages), shard_count)
+            for packages in stages]
+
+def spreadBuildShard(dependencies, packages, shard_count):
+    # Group the packages that are connected within this stage
+    groups = {name: {name} for name in packages}
+    for name in packages:
+        for dep in dependencies[name]:
+            if dep in packages and groups[dep] is not groups[name]:
+                merged = groups[name] | groups[dep]
+                for member in merged:
+                    groups[member] = merged
+
+    unique = {id(group): group for group in groups.values()}.values()
+    shards = [[] for _ in range(shard_count)]
+    for group in sorted(unique, key=lambda g: (-len(g), min(g))):
+        min(shards, key=len).extend(group)
+    return [sorted(shard) for shard in shards if shard]
+
+class PlanBuildShards(buildstep.BuildStep):
+    """Compute the build shards from the installation manifest of the build
+
+    The plan is stored in the 'build_shards' property (see planBuildShards).
+    Only the packages of the 'build_scope' property are built, if it is set
+    """
+
+    renderables = ['manifest_path']
+
+    def __init__(self, manifest_path, shard_count, max_stages, **kwargs):
+        self.manifest_path = manifest_path
+        self.shard_count = shard_count
+        self.max_stages = max_stages
+        super().__init__(**kwargs)
+
+    def plan(self, scope):
+        with open(self.manifest_path) as f:
+            manifest = yaml.safe_load(f)
+        dependencies = restrictDependencies(
+            installationManifestDependencies(manifest), scope)
+        return planBuildShards(dependencies, self.shard_count, self.max_stages)
+
+    @defer.inlineCallbacks
+    def run(self):
+        plan = yield threads.deferToThread(self.plan, self.getProperty('build_scope'))
+        self.setProperty('build_shards', plan, 'PlanBuildShards', runtime=True)
+
+        summary = []
+        for i, stage in enumerate(plan):
+            summary.append(f"stage {i}: " + ", ".join(str(len(shard)) for shard in stage))
+        yield self.addCompleteLog('plan', "\n".join(summary))
+        return util.SUCCESS
+
+class TriggerBuildShards(steps.Trigger):
+    """Trigger one build per shard of a stage of the 'build_shards' property"""
+
+    def __init__(self, stage, **kwargs):
+        self.stage = stage
+        super().__init__(**kwargs)
+
+    def getSchedulersAndProperties(self):
+        shards = self.getProperty('build_shards')[self.stage]
+        return [
+            {
+                'sched_name': sched,
+                'props_to_set': {
+                    **self.set_properties,
+                    'build_shard_packages': shard
+                },
+                'unimportant': False
+            }
+            for sched in self.schedulerNames
+            for shard in shards
+        ]
+
+def hasBuildShardStage(stage):
+    return lambda step: len(step.getProperty('build_shards', [])) > stage
+
+BUILD_SHARD_PROPERTIES = ['seed_config', 'branch', 'ruby', 'rebuild',
+                          'parallel_build_level', 'memory_per_build_process_G',
+                          'local_build_cache']
+
+def DistributedBuild(factory, scheduler, shard_count, max_stages=3):
+    """Build the workspace's packages in builds triggered on `scheduler`
+
+    The shards are computed from the installation manifest uploaded by
+    UploadInstallationManifest (see planBuildShards), and the package
+    versions of this build are pinned in the triggered builds (see
+    BuildShard). The triggered builds push their results to this build's
+    build cache, which this build then uses
+    """
+
+    factory.addStep(steps.ShellCommand(name="Save the versions for the build shards",
+        command=[".autoproj/bin/autoproj", "versions", "--local", "--interactive=f",
+                 "--save=build-shard-versions.yml"],
+        haltOnFailure=True))
+    factory.addStep(steps.FileUpload(name="Upload the versions for the build shards",
+        workersrc="build-shard-versions.yml",
+        masterdest=ReportPathRender("build_shards/", "/versions.yml"),
+        haltOnFailure=True))
+    factory.addStep(PlanBuildShards(INSTALLATION_MANIFEST, shard_count, max_stages,
+        name="Plan the build shards",
+        haltOnFailure=True))
+
+    for stage in range(max_stages):
+        # Shard failures are not fatal. This build's own build step rebuilds
+        # whatever the shards did not push to the cache, and reports it
+        factory.addStep(TriggerBuildShards(stage,
+            name=f"Build shards of stage {stage}",
+            schedulerNames=[scheduler],
+            waitForFinish=True,
+            flunkOnFailure=False,
+            warnOnFailure=True,
+            copy_properties=BUILD_SHARD_PROPERTIES,
+            set_properties={
+                'build_cache_key': util.Interpolate("%(prop:build_cache_key:-%(prop:buildername)s)s"),
+                'build_shard_versions': ReportPathRender("build_shards/", "/versions.yml")
+            },
+            doStepIf=hasBuildShardStage(stage)))
+
+def BuildShard(factory, build_timeout=1200):
+    """Build the packages listed in the 'build_shard_packages' property
+
+    This is the build side of DistributedBuild, meant to run after
+    Bootstrap. The package versions of the build that triggered it are
+    pinned through an overrides file before the update, and the results
+    pushed to the triggering build's build cache
+    """
+
+    factory.addStep(steps.FileDownload(
+        name="Pin the package versions of the triggering build",
+        workerdest="autoproj/overrides.d/99-build-shard-versions.yml",
+        mastersrc=util.Property('build_shard_versions'),
+        haltOnFailure=True))
+
+    Update(factory)
+
+    p = util.Interpolate('-p%(prop:parallel_build_level:-1)s')
     Barrier(factory, "build")
     AutoprojStep(factory, "ci", "build", "--interactive=f", "-k", p,
         "--progress=t",
         "--cache", CACHE_BUILD_DIR,
+        # --cache-ignore takes all the arguments that follow it
+        util.Property('build_shard_packages'),
+        "--cache-ignore", util.Transform(str.split, util.Interpolate("%(prop:rebuild)s"), " "),
+        name="Building the shard's packages",
+        timeout=build_timeout)
+    AutoprojStep(factory, "ci", "cache-push", "--interactive=f", CACHE_BUILD_DIR,
+        name="Pushing to the build cache",
+        ifReached="build")
+
+TEST_SHARDS_SCRIPT = "/buildbot/test-shards"
+
+def shardTests(packages, durations, shard_count):
+    """Spread packages over shards so that the shards take about the same time
+
+    `durations` is the estimated test duration of each package. Packages
+    without an estimate get the median of the known durations, or 1 if
+    there are none. Returns a list of at most shard_count sorted lists of
+    package names
+    """
+
+    known = sorted(durations.values())
+    default = known[len(known) // 2] if known else 1
+
+    shards = [(0, []) for _ in range(shard_count)]
+    estimates = sorted(((durations.get(name, default), name) for name in packages),
+                       key=lambda e: (-e[0], e[1]))
+    for duration, name in estimates:
+        index = min(range(shard_count), key=lambda i: shards[i][0])
+        total, names = shards[index]
+        shards[index] = (total + duration, names + [name])
+    return [sorted(names) for _, names in shards if names]
+
+class PlanTestShards(buildstep.BuildStep):
+    """Compute the test shards from the installation manifest of the build
+
+    The test durations of the builder's previous builds (see
+    RecordTestDurations) are used to balance the shards. Only the packages
+    of the 'build_scope' property are tested, if it is set. The plan is
+    saved in the 'test_shards' property as one line per shard, listing the
+    shard's packages
+    """
+
+    renderables = ['manifest_path']
+
+    def __init__(self, manifest_path, shard_count, db_path=history.HISTORY_DB_PATH,
+                 **kwargs):
+        self.manifest_path = manifest_path
+        self.shard_count = shard_count
+        self.db_path = db_path
+        super().__init__(**kwargs)
+
+    def plan(self, builder_name, scope):
+        with open(self.manifest_path) as f:
+            manifest = yaml.safe_load(f)
+        packages = restrictDependencies(
+            installationManifestDependencies(manifest), scope).keys()
+        durations = history.test_duration_estimates(self.db_path, builder_name)
+        return shardTests(packages, durations, self.shard_count)
+
+    @defer.inlineCallbacks
+    def run(self):
+        shards = yield threads.deferToThread(
+            self.plan, self.getProperty('buildername'), self.getProperty('build_scope'))
+        plan = "".join(" ".join(shard) + "\n" for shard in shards)
+        self.setProperty('test_shards', plan, 'PlanTestShards', runtime=True)
+        yield self.addCompleteLog('plan', plan)
+        return util.SUCCESS
+
+def ShardedTests(factory, shard_count, test_utilities):
+    """Run the tests in shard_count parallel `autoproj ci test` processes
+
+    Each shard has its own Xvfb display and omniNames instance, on distinct
+    display numbers and ports. Each shard writes its test report in its own
+    file (see 99-test-shard-report.rb), and test-shards merges them in
+    autoproj's test report once all shards finished. The xunit results are
+    in the packages' own test result directories, which
+    `process-test-results` then collects as usual
+    """
+
+    factory.addStep(PlanTestShards(INSTALLATION_MANIFEST, shard_count,
+        name="Plan the test shards",
+        haltOnFailure=True))
+    factory.addStep(steps.StringDownload(util.Property('test_shards'),
+        workerdest="test-shards.txt",
+        name="Save the test shards",
+        haltOnFailure=True))
+    factory.addStep(steps.FileDownload(name="copy the test shards script",
+        workerdest=TEST_SHARDS_SCRIPT,
+        mastersrc="test-shards",
+        mode=0o755,
+        haltOnFailure=True))
+    factory.addStep(steps.FileDownload(name="copy the test shard report override",
+        workerdest="autoproj/overrides.d/99-test-shard-report.rb",
+        mastersrc="99-test-shard-report.rb",
+        haltOnFailure=True))
+
+    options = []
+    if 'x11' in test_utilities:
+        options.append("--x11")
+    if 'omniorb' in test_utilities:
+        options.append("--omniorb")
+
+    p = util.Interpolate('-p%(prop:parallel_test_level:-1)s')
+    factory.addStep(steps.ShellCommand(name="Running unit tests",
+        command=[TEST_SHARDS_SCRIPT, "test-shards.txt", *options, "--",
+                 "--interactive=f", "-k", p],
+        haltOnFailure=True))
+
+def testLogDuration(path):
+    """Duration of the test of a package, from its autobuild log
+
+    The test starts at the timestamp of the first command in the log, and
+    ends when the log was last modified. Returns None if the log has no
+    timestamp
+    """
+
+    with open(path, errors='replace') as f:
+        for line in f:
+            match = TEST_LOG_TIMESTAMP.match(line)
+            if match:
+                start = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S %z")
+                return max(0, os.stat(path).st_mtime - start.timestamp())
+
+TEST_LOG_TIMESTAMP = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d [+-]\d{4}): running")
+
+def reportTestDurations(report_folder):
+    """Duration of the tests of each package of an extracted report"""
+
+    logdir = Path(report_folder) / 'logs'
+    durations = {}
+    for path in logdir.rglob("*-test.log"):
+        relative = path.relative_to(logdir)
+        if relative.parts[0] == 'test-results':
+            continue
+        duration = testLogDuration(path)
+        if duration is not None:
+            name = "/".join((*relative.parts[:-1], relative.name[:-len("-test.log")]))
+            durations[name] = duration
+    return durations
+
+class RecordTestDurations(buildstep.BuildStep):
+    """Record the test duration of each package in the history database
+
+    They are used by PlanTestShards to balance the test shards of the next
+    builds. The step must run before the report logs get compressed
+    """
+
+    renderables = ['report_folder']
+
+    def __init__(self, report_folder, db_path=history.HISTORY_DB_PATH, **kwargs):
+        self.report_folder = report_folder
+        self.db_path = db_path
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        builder_name, build_number, reports_name = reportNames(self.build.getProperties())
+        durations = yield threads.deferToThread(reportTestDurations, self.report_folder)
+        if not durations:
+            return util.SKIPPED
+
+        yield threads.deferToThread(
+            history.record_test_durations, self.db_path, reports_name,
+            builder_name, build_number, durations,
+            real_builder_name=self.getProperty('buildername'))
+        return util.SUCCESS
+
+def UploadInstallationManifest(factory):
+    """Upload the installation manifest to INSTALLATION_MANIFEST on the master
+
+    This is the source of the package dependency graph for the steps that
+    plan a build on the master (ScopeBuildToChanges, PlanBuildShards and
+    PlanTestShards)
+    """
+
+    factory.addStep(steps.FileUpload(name="Upload the installation manifest",
+        workersrc=".autoproj/installation-manifest",
+        masterdest=INSTALLATION_MANIFEST,
+        haltOnFailure=True))
+
+def restrictDependencies(dependencies, scope):
+    """Restrict a dependency graph to the packages of `scope`
+
+    The graph is returned as-is if scope is None
+    """
+
+    if scope is None:
+        return dependencies
+    scope = set(scope)
+    return {
+        name: [dep for dep in deps if dep in scope]
+        for name, deps in dependencies.items() if name in scope
+    }
+
+def normalizeRepositoryURL(url):
+    """Normalize a git URL so that the different forms of a repository's URL
+    compare equal (e.g. git@github.com:org/repo.git and
+    https://github.com/org/repo)
+    """
+
+    url = url.strip().rstrip('/')
+    match = re.match(r"^[\w.-]+@([\w.-]+):(.*)$", url)
+    if match:
+        url = f"{match.group(1)}/{match.group(2)}"
+    else:
+        url = re.sub(r"^[a-z+]+://([^@/]+@)?", "", url)
+    if url.endswith(".git"):
+        url = url[:-4]
+    host, _, path = url.partition('/')
+    return f"{host.lower()}/{path}"
+
+def changedPackages(manifest, repositories):
+    """Names of the packages of an installation manifest imported from any
+    of the given repositories
+    """
+
+    repositories = {normalizeRepositoryURL(url) for url in repositories}
+    packages = set()
+    for entry in manifest or []:
+        if 'name' not in entry or 'package_set' in entry:
+            continue
+        url = (entry.get('vcs') or {}).get('url')
+        if url and normalizeRepositoryURL(url) in repositories:
+            packages.add(entry['name'])
+    return packages
+
+def reverseDependencyClosure(dependencies, packages):
+    """The given packages and all the packages that depend on them"""
+
+    reverse = {}
+    for name, deps in dependencies.items():
+        for dep in deps:
+            reverse.setdefault(dep, []).append(name)
+
+    closure = set()
+    queue = list(packages)
+    while queue:
+        name = queue.pop()
+        if name not in closure:
+            closure.add(name)
+            queue.extend(reverse.get(name, []))
+    return closure
+
+class ScopeBuildToChanges(buildstep.BuildStep):
+    """Restrict the build to the packages affected by the build's changes
+
+    The packages imported from the changes' repositories and their reverse
+    dependencies are saved in the 'build_scope' property. The property is
+    not set, and the whole workspace is built, if the build has no changes
+    or if one of the repositories does not match any package (e.g. a change
+    of the build configuration or of a package set)
+    """
+
+    renderables = ['manifest_path']
+
+    def __init__(self, manifest_path, **kwargs):
+        self.manifest_path = manifest_path
+        super().__init__(**kwargs)
+
+    def scope(self, repositories):
+        with open(self.manifest_path) as f:
+            manifest = yaml.safe_load(f)
+
+        changed = set()
+        for url in repositories:
+            packages = changedPackages(manifest, [url])
+            if not packages:
+                return (None, f"{url} does not match any package, building everything")
+            changed |= packages
+
+        dependencies = installationManifestDependencies(manifest)
+        closure = reverseDependencyClosure(dependencies, changed)
+        return (sorted(closure),
+                f"changed packages: {' '.join(sorted(changed))}\n"
+                f"build scope ({len(closure)}/{len(dependencies)} packages): "
+                f"{' '.join(sorted(closure))}")
+
+    @defer.inlineCallbacks
+    def run(self):
+        repositories = {change.repository for change in self.build.allChanges()
+                        if change.repository}
+        if not repositories:
+            return util.SKIPPED
+
+        scope, summary = yield threads.deferToThread(self.scope, repositories)
+        yield self.addCompleteLog('scope', summary)
+        if scope is None:
+            return util.SKIPPED
+        self.setProperty('build_scope', scope, 'ScopeBuildToChanges', runtime=True)
+        return util.SUCCESS
+
+def Build(factory, tests=True, test_utilities=['omniorb', 'x11'], build_timeout=1200,
+          record_resource_usage=False, local_cache_max_size_GB=None,
+          shard_scheduler=None, shard_count=4, shard_max_stages=3,
+          test_shards=0, change_scoped=False):
+    """Build and test the workspace
+
+    If local_cache_max_size_GB is set, the build uses the node-local tier of
+    the build cache, which must be mounted by the worker (see BuildWorker).
+    The entries the build needs are copied from the shared cache before the
+    build, and the new entries are published to the shared cache after it.
+    The local tier is trimmed to local_cache_max_size_GB before the build
+
+    If shard_scheduler is set, the packages are first built by builds
+    triggered on this scheduler, up to shard_count in parallel (see
+    DistributedBuild). The build itself then mostly gets its packages from
+    the build cache
+
+    If test_shards is set, the tests run in that many parallel processes,
+    each with its own X display and omniORB name service (see ShardedTests)
+
+    If change_scoped is set, only the packages affected by the build's
+    changes and their reverse dependencies are built and tested (see
+    ScopeBuildToChanges). The other packages are taken from the build cache
+    """
+
+    p = util.Interpolate('-p%(prop:parallel_build_level:-1)s')
+
+    if record_resource_usage:
+        factory.addStep(steps.FileDownload(name="copy the resource usage script",
+            workerdest=RESOURCE_USAGE_SCRIPT,
+            mastersrc="resource-usage",
+            mode=0o755,
+            haltOnFailure=True))
+        factory.addStep(steps.ShellCommand(name="Start sampling resource usage",
+            command=[RESOURCE_USAGE_SCRIPT, "start", RESOURCE_USAGE_SAMPLES],
+            flunkOnFailure=False,
+            warnOnFailure=True))
+
+    Barrier(factory, "build")
+
+    if change_scoped or shard_scheduler is not None or (tests and test_shards):
+        UploadInstallationManifest(factory)
+    if change_scoped:
+        factory.addStep(ScopeBuildToChanges(INSTALLATION_MANIFEST,
+            name="Scope the build to the changed packages",
+            haltOnFailure=True))
+    scope = util.Property('build_scope', default=[])
+
+    if shard_scheduler is not None:
+        DistributedBuild(factory, shard_scheduler, shard_count,
+                         max_stages=shard_max_stages)
+
+    build_cache_dir = CACHE_BUILD_DIR
+    if local_cache_max_size_GB is not None:
+        build_cache_dir = CACHE_BUILD_LOCAL_DIR
+        LocalBuildCacheFetch(factory, local_cache_max_size_GB)
+
+    AutoprojStep(factory, "ci", "build", "--interactive=f", "-k", p,
+        "--progress=t",
+        "--cache", build_cache_dir,
+        # --cache-ignore takes all the arguments that follow it
+        scope,
         "--cache-ignore", util.Transform(str.split, util.Interpolate("%(prop:rebuild)s"), " "),
         name="Building the workspace",
         timeout=build_timeout)
@@ -394,38 +1675,394 @@ def Build(factory, tests=True, test_utilities=['omniorb', 'x11'], build_timeout=
             wrapper=['xvfb-run']
 
         p = util.Interpolate('-p%(prop:parallel_test_level:-1)s')
-        AutoprojStep(factory, "ci", "test", "--interactive=f", "-k", p,
-            name="Running unit tests", wrapper=wrapper)
+        if test_shards:
+            ShardedTests(factory, test_shards, test_utilities)
+        else:
+            AutoprojStep(factory, "ci", "test", "--interactive=f", "-k", p, scope,
+                name="Running unit tests", wrapper=wrapper)
 
         AutoprojStep(factory, "ci", "process-test-results", "--interactive=f",
             util.Interpolate("--xunit-viewer=%(prop:xunit-viewer:-/usr/local/bin/xunit-viewer)s"),
             name="Postprocess test results",
             ifReached="test")
 
-    AutoprojStep(factory, "ci", "cache-push", "--interactive=f", CACHE_BUILD_DIR,
+    AutoprojStep(factory, "ci", "cache-push", "--interactive=f", build_cache_dir,
         name="Pushing to the build cache",
         ifReached="build")
 
+    if local_cache_max_size_GB is not None:
+        factory.addStep(steps.ShellCommand(name="Publish to the shared build cache",
+            command=[BUILD_CACHE_TIER_SCRIPT, "publish",
+                     CACHE_BUILD_LOCAL_DIR, CACHE_BUILD_DIR],
+            flunkOnFailure=False,
+            warnOnFailure=True,
+            alwaysRun=True,
+            doStepIf=hasReachedBarrier("build")))
+
+    if change_scoped or shard_scheduler is not None or (tests and test_shards):
+        factory.addStep(steps.MasterShellCommand(
+            name="Delete the build planning files on the master",
+            command=["rm", "-rf", ReportPathRender("build_manifests/", ""),
+                     ReportPathRender("build_shards/", "")],
+            flunkOnFailure=False,
+            warnOnFailure=True,
+            alwaysRun=True))
+
+def LocalBuildCacheFetch(factory, max_size_GB):
+    """Prepare the node-local tier of the build cache for the build
+
+    The fingerprints of the workspace's packages determine which entries
+    the build will look for. Failures only cause cache misses, so none of
+    these steps halt the build
+    """
+
+    factory.addStep(steps.FileDownload(name="copy the build cache tier script",
+        workerdest=BUILD_CACHE_TIER_SCRIPT,
+        mastersrc="build-cache-tier",
+        mode=0o755,
+        haltOnFailure=True))
+    factory.addStep(steps.ShellCommand(name="Fix permissions on the local build cache",
+        command=["sudo", "chown", "buildbot", CACHE_BUILD_LOCAL_BASE_DIR],
+        haltOnFailure=True))
+    factory.addStep(steps.ShellCommand(name="Trim the local build cache",
+        command=[BUILD_CACHE_TIER_SCRIPT, "trim", CACHE_BUILD_LOCAL_BASE_DIR,
+                 f"--max-size={max_size_GB}"],
+        flunkOnFailure=False,
+        warnOnFailure=True))
+    factory.addStep(steps.ShellCommand(name="Compute the package fingerprints",
+        command=[".autoproj/bin/autoproj", "versions", "--local", "--fingerprint",
+                 "--interactive=f", "--save=build-cache-fingerprints.yml"],
+        flunkOnFailure=False,
+        warnOnFailure=True))
+    factory.addStep(steps.ShellCommand(name="Fetch from the shared build cache",
+        command=[BUILD_CACHE_TIER_SCRIPT, "fetch", CACHE_BUILD_LOCAL_DIR,
+                 CACHE_BUILD_DIR, "build-cache-fingerprints.yml"],
+        flunkOnFailure=False,
+        warnOnFailure=True))
+
 class ReportPathRender:
     def __init__(self, prefix, suffix):
         self.prefix = prefix
         self.suffix = suffix
 
     def getRenderingFor(self, props):
-        name = props.getProperty(
-            'virtual_builder_name',
-            props.getProperty('buildername')
-        )
-        name = name.replace('/', ':')
-        number = props.getProperty('buildnumber')
+        _, _, reports_name = reportNames(props)
+        return f"{self.prefix}{reports_name}{self.suffix}"
+
+# Where UploadInstallationManifest saves the build's installation manifest
+INSTALLATION_MANIFEST = ReportPathRender("build_manifests/", "/installation-manifest")
+
+def reportNames(props):
+    """Return the builder name, build number and report name of a build"""
+
+    builder_name = props.getProperty(
+        'virtual_builder_name',
+        props.getProperty('buildername')
+    )
+    number = props.getProperty('buildnumber')
+    reports_name = f"{builder_name}-{number}".replace('/', ':')
+    return (builder_name, number, reports_name)
+
+def phaseDurations(props, end):
+    """Compute the duration of each reached phase from the barrier times
+
+    Each phase starts when its barrier is reached, and ends when the next
+    reached phase starts. The last one ends at `end`
+    """
+
+    times = []
+    for phase in history.BUILD_PHASES:
+        start = props.getProperty(f"{phase}BarrierTime")
+        if start is not None:
+            times.append((phase, start))
+
+    durations = {}
+    for (phase, start), (_, next_start) in zip(times, times[1:] + [(None, end)]):
+        durations[phase] = next_start - start
+    return durations
+
+class WriteDashboardIndex(buildstep.BuildStep):
+    """Generate the dashboard's index of an extracted report
+
+    The index saves the dashboard from having to list the log directory
+    of every package each time it loads a report
+    """
+
+    renderables = ['report_folder']
+
+    def __init__(self, report_folder, **kwargs):
+        self.report_folder = report_folder
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        written = yield threads.deferToThread(
+            dashboard.write_dashboard_index, Path(self.report_folder))
+        if written:
+            return util.SUCCESS
+        else:
+            return util.SKIPPED
+
+class IngestBuildHistory(buildstep.BuildStep):
+    """Store the package results of an extracted report in the history database
+
+    The history database is what the dashboard uses for cross-build queries
+    (flaky packages, first failing build, builder success rates)
+    """
+
+    def __init__(self, db_path=history.HISTORY_DB_PATH, **kwargs):
+        self.db_path = db_path
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        builder_name, build_number, reports_name = reportNames(self.build.getProperties())
+
+        report = yield threads.deferToThread(
+            dashboard.package_info_for, reports_name)
+        if report is None:
+            return util.SKIPPED
+
+        yield threads.deferToThread(
+            history.ingest_report, self.db_path, reports_name,
+            builder_name, build_number, report)
+        return util.SUCCESS
+
+class RecordPhaseTimings(buildstep.BuildStep):
+    """Record the duration of the build phases reached so far
+
+    The durations are saved in the report as timings.json, and in the history
+    database. The step may be added more than once, each run replacing the
+    timings saved by the previous one
+    """
+
+    renderables = ['report_folder']
+
+    def __init__(self, report_folder, db_path=history.HISTORY_DB_PATH, **kwargs):
+        self.report_folder = report_folder
+        self.db_path = db_path
+        super().__init__(**kwargs)
 
-        return f"{self.prefix}{name}-{number}{self.suffix}"
+    @defer.inlineCallbacks
+    def run(self):
+        props = self.build.getProperties()
+        builder_name, build_number, reports_name = reportNames(props)
+        durations = phaseDurations(props, time.time())
+
+        yield threads.deferToThread(self.writeTimings, durations)
+        yield threads.deferToThread(
+            history.record_phase_durations, self.db_path, reports_name,
+            builder_name, build_number, durations)
+
+        summary = ", ".join(f"{phase}={int(d)}s" for phase, d in durations.items())
+        yield self.addCompleteLog("timings", summary)
+        return util.SUCCESS
+
+    def writeTimings(self, durations):
+        report_folder = Path(self.report_folder)
+        if report_folder.is_dir():
+            with open(report_folder / dashboard.TIMINGS_NAME, 'w') as f:
+                f.write(json.dumps(durations))
+
+class StreamingDirectoryWriter(base.FileWriterImpl):
+    """Extract a directory upload on the master while it is being received
+
+    Unlike Buildbot's own DirectoryWriter, the archive is piped to tar as it
+    arrives instead of being saved to disk first. If `archive` is set, the
+    received archive is also saved there.
+    """
+
+    def __init__(self, destroot, maxsize, compress, archive=None):
+        self.destroot = destroot
+        self.remaining = maxsize
+        self.archive_path = archive
+        self.archive = None
+        os.makedirs(destroot, exist_ok=True)
+
+        tar_flags = { 'bz2': ['-j'], 'gz': ['-z'] }.get(compress, [])
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            ["tar", "-x", *tar_flags, "-f", "-", "-C", destroot],
+            stdin=subprocess.PIPE, stderr=self.stderr)
+        if archive is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(archive)), exist_ok=True)
+            self.archive = open(archive, 'wb')
+
+    def remote_write(self, data):
+        data = unicode2bytes(data)
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+
+        self.process.stdin.write(data)
+        if self.archive is not None:
+            self.archive.write(data)
+
+    def remote_utime(self, accessed_modified):
+        pass
+
+    def remote_close(self):
+        if not self.process.stdin.closed:
+            self.process.stdin.close()
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def remote_unpack(self):
+        self.remote_close()
+        if self.process.wait() != 0:
+            self.stderr.seek(0)
+            error = self.stderr.read().decode(errors='replace')
+            raise RuntimeError(f"failed to extract the upload in {self.destroot}: {error}")
+        self.stderr.close()
+
+    def cancel(self):
+        # Buildbot calls cancel after all transfers, successful or not
+        if self.process.poll() is None:
+            self.remote_close()
+            self.process.kill()
+            self.process.wait()
+            self.purge()
+
+    def purge(self):
+        if self.archive_path is not None and os.path.exists(self.archive_path):
+            os.unlink(self.archive_path)
+        if os.path.isdir(self.destroot):
+            shutil.rmtree(self.destroot)
+
+class StreamingDirectoryUpload(steps.DirectoryUpload):
+    """Upload a directory from the worker, extracting it on the master as
+    it is received
+
+    `archive` optionally names a file in which the received archive is
+    saved as well
+    """
+
+    renderables = ['archive']
+
+    def __init__(self, workersrc, masterdest, archive=None, **kwargs):
+        self.archive = archive
+        super().__init__(workersrc=workersrc, masterdest=masterdest, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        self.checkWorkerHasCommand("uploadDirectory")
+        self.stdio_log = yield self.addLog("stdio")
+        self.descriptionDone = f"uploading {os.path.basename(self.workersrc)}"
+
+        # the master runs chdir'ed into its basedir, relative paths are
+        # relative to it
+        masterdest = os.path.expanduser(self.masterdest)
+        writer = StreamingDirectoryWriter(masterdest, self.maxsize,
+                                          self.compress, archive=self.archive)
+        args = {
+            'workdir': self.workdir,
+            'writer': writer,
+            'maxsize': self.maxsize,
+            'blocksize': self.blocksize,
+            'compress': self.compress,
+            'workersrc': self.workersrc
+        }
+
+        cmd = makeStatusRemoteCommand(self, 'uploadDirectory', args)
+        res = yield self.runTransferCommand(cmd, writer)
+        return res
+
+def UploadReportTarball(factory, report_folder, compression):
+    backend = compressionBackend(compression)
+    report_tar_name = f"build_report.tar.{backend['suffix']}"
+    report_tar = ReportPathRender("build_reports/", f".tar.{backend['suffix']}")
+
+    factory.addStep(steps.ShellCommand(name="Compress the report directory",
+        command=["tar", "--create", "--use-compress-program", backend['program'],
+                 "--file", report_tar_name, "buildbot-report"],
+        alwaysRun=True,
+        doStepIf=hasReachedBarrier("update")
+    ))
+    factory.addStep(steps.FileUpload(name="Download the report",
+        workersrc=report_tar_name,
+        masterdest=report_tar,
+        alwaysRun=True,
+        doStepIf=hasReachedBarrier("update")))
+    factory.addStep(steps.MasterShellCommand(name="Create the report directory",
+        command=["mkdir", "-p", report_folder],
+        alwaysRun=True,
+        doStepIf=hasReachedBarrier("update")
+    ))
+    factory.addStep(steps.MasterShellCommand(name="Extract the report on the master",
+        command=["tar", "--extract", "--use-compress-program", backend['decompress'],
+                 "--file", report_tar,
+                 "-C", report_folder,
+                 "--strip-components=1"],
+        alwaysRun=True,
+        doStepIf=hasReachedBarrier("update")
+    ))
+
+def UploadReportStream(factory, report_folder, compression, keep_archive):
+    if compression not in STREAM_COMPRESSION:
+        config.error(f"compression '{compression}' cannot be used to stream "
+                     f"the report, use one of {', '.join(STREAM_COMPRESSION)}")
+
+    compress, suffix = STREAM_COMPRESSION[compression]
+    archive = None
+    if keep_archive:
+        archive = ReportPathRender("build_reports/", f".{suffix}")
+
+    factory.addStep(StreamingDirectoryUpload(name="Download and extract the report",
+        workersrc="buildbot-report",
+        masterdest=report_folder,
+        compress=compress,
+        archive=archive,
+        alwaysRun=True,
+        doStepIf=hasReachedBarrier("update")))
+
+class RecordResourceUsage(buildstep.BuildStep):
+    """Record the peak CPU and memory usage of the build in the history database
+
+    They are used by BuildWorker to size the pods of the next builds
+    """
+
+    def __init__(self, db_path=history.HISTORY_DB_PATH, **kwargs):
+        self.db_path = db_path
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        builder_name, build_number, reports_name = reportNames(self.build.getProperties())
+        yield threads.deferToThread(
+            history.record_resource_usage, self.db_path, reports_name,
+            builder_name, build_number,
+            self.getProperty('peak_cpu'), self.getProperty('peak_memory_bytes'),
+            real_builder_name=self.getProperty('buildername'))
+        return util.SUCCESS
+
+def parseResourceUsage(rc, stdout, stderr):
+    if rc != 0:
+        return {}
+    return json.loads(stdout)
+
+def BuildReport(factory, compress_logs=False, compression="bzip2",
+                stream_upload=False, keep_archive=False,
+                record_resource_usage=False, record_cache_access=False,
+                record_test_durations=False):
+    Barrier(factory, "report",
+        alwaysRun=True,
+        doStepIf=hasReachedBarrier("update"))
 
-def BuildReport(factory):
     AutoprojStep(factory, "ci", "create-report", "--interactive=f", "buildbot-report",
         name="Generating report",
         ifReached="update")
 
+    if record_resource_usage:
+        factory.addStep(steps.SetPropertyFromCommand(name="Compute the peak resource usage",
+            command=[RESOURCE_USAGE_SCRIPT, "summary", RESOURCE_USAGE_SAMPLES,
+                     "buildbot-report/resources.json"],
+            extract_fn=parseResourceUsage,
+            flunkOnFailure=False,
+            warnOnFailure=True,
+            alwaysRun=True,
+            doStepIf=hasReachedBarrier("build")))
+
     AutoprojStep(factory, "envsh", "--interactive=f",
         name="Regen the env.sh file",
         ifReached="update")
@@ -435,6 +2072,22 @@ def BuildReport(factory):
         name="Generating versions file",
         ifReached="update")
 
+    if record_cache_access:
+        # Feeds the build cache eviction done by MaintainBuildCache
+        factory.addStep(steps.FileDownload(name="copy the build cache index script",
+            workerdest=BUILD_CACHE_INDEX_SCRIPT,
+            mastersrc="build-cache-index",
+            mode=0o755,
+            alwaysRun=True,
+            doStepIf=hasReachedBarrier("build")))
+        factory.addStep(steps.ShellCommand(name="Record the build cache accesses",
+            command=[BUILD_CACHE_INDEX_SCRIPT, "record", CACHE_BUILD_DIR,
+                     "buildbot-report/versions.yml", "buildbot-report/report.json"],
+            flunkOnFailure=False,
+            warnOnFailure=True,
+            alwaysRun=True,
+            doStepIf=hasReachedBarrier("build")))
+
     vm_uuid = str(uuid.uuid4())
     factory.addStep(steps.StringDownload(vm_uuid,
         workerdest=f"buildbot-report/uuid",
@@ -444,7 +2097,6 @@ def BuildReport(factory):
     ))
 
     report_folder = ReportPathRender("build_reports/", "")
-    report_tar    = ReportPathRender("build_reports/", ".tar.bz2")
 
     factory.addStep(steps.ShellCommand(name="Copy the installation manifest",
         command=["cp", ".autoproj/installation-manifest",
@@ -467,28 +2119,53 @@ def BuildReport(factory):
         alwaysRun=True,
         doStepIf=hasReachedBarrier("update")
     ))
-    factory.addStep(steps.ShellCommand(name="Compress the report directory",
-        command=["tar", "cjf", "build_report.tar.bz2", "buildbot-report"],
+    if stream_upload:
+        UploadReportStream(factory, report_folder, compression, keep_archive)
+    else:
+        UploadReportTarball(factory, report_folder, compression)
+
+    if record_test_durations:
+        factory.addStep(RecordTestDurations(report_folder,
+            name="Record the test durations",
+            flunkOnFailure=False,
+            warnOnFailure=True,
+            alwaysRun=True,
+            doStepIf=hasReachedBarrier("test")))
+
+    if compress_logs:
+        # The dashboard decompresses the logs on the fly, or passes them
+        # as-is to browsers that accept gzip
+        factory.addStep(steps.MasterShellCommand(name="Compress the report logs on the master",
+            command=["find", ReportPathRender("build_reports/", "/logs"),
+                     "-type", "f",
+                     "(", "-name", "*.log", "-o", "-name", "*.html", ")",
+                     "-exec", "gzip", "-f", "{}", "+"],
+            flunkOnFailure=False,
+            warnOnFailure=True,
+            alwaysRun=True,
+            doStepIf=hasReachedBarrier("update")
+        ))
+    factory.addStep(WriteDashboardIndex(report_folder,
+        name="Index the report for the dashboard",
         alwaysRun=True,
         doStepIf=hasReachedBarrier("update")
     ))
-    factory.addStep(steps.FileUpload(name="Download the report",
-        workersrc="build_report.tar.bz2",
-        masterdest=report_tar,
-        alwaysRun=True,
-        doStepIf=hasReachedBarrier("update")))
-    factory.addStep(steps.MasterShellCommand(name="Create the report directory",
-        command=["mkdir", "-p", report_folder],
+    factory.addStep(IngestBuildHistory(
+        name="Add the report to the build history",
         alwaysRun=True,
         doStepIf=hasReachedBarrier("update")
     ))
-    factory.addStep(steps.MasterShellCommand(name="Extract the report on the master",
-        command=["tar", "xjf", report_tar,
-                 "-C", report_folder,
-                 "--strip-components=1"],
+    factory.addStep(RecordPhaseTimings(report_folder,
+        name="Record the phase timings",
         alwaysRun=True,
         doStepIf=hasReachedBarrier("update")
     ))
+    if record_resource_usage:
+        factory.addStep(RecordResourceUsage(
+            name="Record the peak resource usage",
+            alwaysRun=True,
+            doStepIf=lambda step: step.getProperty('peak_memory_bytes') is not None
+        ))
 
 def StandardSetup(c, name, buildconf_url,
                   buildconf_default_branch="master",
@@ -507,12 +2184,29 @@ def StandardSetup(c, name, buildconf_url,
                   import_timeout=1200,
                   build_timeout=1200,
                   build_cache_max_size_GB=None,
+                  record_build_cache_access=False,
+                  local_build_cache=None,
+                  local_build_cache_max_size_GB=50,
+                  test_shards=0,
+                  change_scoped_builds=False,
+                  osdeps_cache_window_h=None,
+                  build_shards=0,
+                  build_shard_stages=3,
+                  shard_workers=None,
+                  bootstrap_snapshot=False,
+                  import_cache_generations=False,
+                  adaptive_resources=False,
+                  compress_reports=False,
+                  report_compression="bzip2",
+                  stream_report=False,
+                  keep_report_archive=False,
                   import_properties={},
                   build_properties={},
                   properties={},
                   tests=True,
                   test_utilities=['omniorb', 'x11'],
                   gem_compile=["ffi"],
+                  gem_compile_jobs=4,
                   autoproj_url=AUTOPROJ_GIT_URL,
                   autobuild_url=AUTOBUILD_GIT_URL,
                   autoproj_ci_url=AUTOPROJ_CI_GIT_URL,
@@ -533,20 +2227,34 @@ def StandardSetup(c, name, buildconf_url,
               seed_config_path=seed_config_path,
               overrides_file_paths=overrides_file_paths,
               flavor=flavor,
+              import_cache_generations=import_cache_generations,
               autoproj_url=autoproj_url,
               autobuild_url=autobuild_url,
               autoproj_ci_url=autoproj_ci_url)
 
     Update(import_cache_factory, import_timeout=import_timeout)
-    UpdateImportCache(import_cache_factory, gem_compile=gem_compile)
+    UpdateImportCache(import_cache_factory, gem_compile=gem_compile,
+                      generations=import_cache_generations,
+                      buildconf_url=buildconf_url)
+
+    if import_cache_generations:
+        import_cache_locks = [cache_import_update_lock.access('exclusive')]
+        # This requires the import cache volume to be ReadWriteMany (NFS in
+        # the GKE integration), as the update and the builds mount it at the
+        # same time
+        build_locks = []
+    else:
+        import_cache_locks = [cache_import_lock.access('exclusive')]
+        build_locks = [cache_import_lock.access('counting')]
 
+    import_properties = { 'gem_compile_jobs': gem_compile_jobs, **import_properties }
     import_properties.update(properties)
     c['builders'].append(
         util.BuilderConfig(name=f"{name}-import-cache",
             workernames=import_workers,
             factory=import_cache_factory,
             properties=import_properties,
-            locks=[cache_import_lock.access('exclusive')])
+            locks=import_cache_locks)
     )
 
     build_factory = util.BuildFactory()
@@ -565,18 +2273,77 @@ def StandardSetup(c, name, buildconf_url,
               overrides_file_paths=overrides_file_paths,
               flavor=flavor,
               build_cache_max_size_GB=build_cache_max_size_GB,
+              bootstrap_snapshot=bootstrap_snapshot,
+              import_cache_generations=import_cache_generations,
               autoproj_url=autoproj_url,
               autobuild_url=autobuild_url,
               autoproj_ci_url=autoproj_ci_url)
 
-    Update(build_factory, import_timeout=import_timeout)
+    Update(build_factory, import_timeout=import_timeout,
+           osdeps_cache_window_h=osdeps_cache_window_h)
+
+    shard_scheduler = None
+    if build_shards:
+        shard_scheduler = f"{name}-build-shard"
+        if shard_workers is None:
+            shard_workers = [f"build-shard-{i}" for i in range(build_shards)]
+
+        shard_factory = util.BuildFactory()
+        if git_credentials:
+            for url in git_credentials:
+                GitCredentials(shard_factory, url, git_credentials[url])
+
+        Bootstrap(shard_factory, buildconf_url,
+                  buildconf_default_branch=buildconf_default_branch,
+                  vcstype=vcstype,
+                  tests=False,
+                  autoproj_branch=autoproj_branch,
+                  autobuild_branch=autobuild_branch,
+                  autoproj_ci_branch=autoproj_ci_branch,
+                  seed_config_path=seed_config_path,
+                  overrides_file_paths=overrides_file_paths,
+                  flavor=flavor,
+                  bootstrap_snapshot=bootstrap_snapshot,
+                  import_cache_generations=import_cache_generations,
+                  autoproj_url=autoproj_url,
+                  autobuild_url=autobuild_url,
+                  autoproj_ci_url=autoproj_ci_url)
+        BuildShard(shard_factory, build_timeout=build_timeout)
+
+        c['builders'].append(
+            util.BuilderConfig(name=shard_scheduler,
+                workernames=shard_workers,
+                factory=shard_factory,
+                properties=properties,
+                locks=build_locks,
+                nextWorker=preferWarmWorkers)
+        )
+        c['schedulers'].append(
+            schedulers.Triggerable(name=shard_scheduler,
+                builderNames=[shard_scheduler]))
+
     Build(build_factory, build_timeout=build_timeout,
-          tests=tests, test_utilities=test_utilities)
-    BuildReport(build_factory)
+          tests=tests, test_utilities=test_utilities,
+          record_resource_usage=adaptive_resources,
+          local_cache_max_size_GB=local_build_cache_max_size_GB if local_build_cache else None,
+          shard_scheduler=shard_scheduler,
+          shard_count=build_shards,
+          shard_max_stages=build_shard_stages,
+          test_shards=test_shards,
+          change_scoped=change_scoped_builds)
+    BuildReport(build_factory, compress_logs=compress_reports,
+                compression=report_compression,
+                stream_upload=stream_report,
+                keep_archive=keep_report_archive,
+                record_resource_usage=adaptive_resources,
+                record_cache_access=record_build_cache_access,
+                record_test_durations=bool(test_shards))
 
     build_properties.update({
         'parallel_build_level': parallel_build_level,
-        'parallel_test_level': parallel_test_level
+        'parallel_test_level': parallel_test_level,
+        'adaptive_resources': adaptive_resources,
+        'local_build_cache': local_build_cache
     })
     build_properties.update(properties)
     c['builders'].append(
@@ -584,17 +2351,144 @@ def StandardSetup(c, name, buildconf_url,
             workernames=build_workers,
             factory=build_factory,
             properties=build_properties,
-            locks=[cache_import_lock.access('counting')] + builder_locks
+            locks=build_locks + builder_locks,
+            nextWorker=preferWarmWorkers
         )
     )
 
     return (import_cache_factory, build_factory)
 
-def BuildArtifacts(factory, workspace=None):
+ARTIFACT_CHUNKS_SCRIPT = "/buildbot/artifact-chunks"
+# Where the workers upload the artifact chunks before they get moved to the
+# chunk store
+ARTIFACT_CHUNKS_UPLOAD = ReportPathRender("build_artifacts/uploads/", "")
+
+class NegotiateArtifactChunks(buildstep.BuildStep):
+    """List the chunks of the artifacts manifest that the chunk store misses
+
+    The list is saved in the 'missing' file of upload_dir, to be sent to the
+    worker
+    """
+
+    renderables = ['manifest', 'upload_dir']
+
+    def __init__(self, manifest, upload_dir,
+                 store_dir=chunkstore.CHUNK_STORE_DIR, **kwargs):
+        self.manifest = manifest
+        self.upload_dir = upload_dir
+        self.store_dir = store_dir
+        super().__init__(**kwargs)
+
+    def negotiate(self):
+        manifest = chunkstore.read_manifest(self.manifest)
+        missing = chunkstore.missing_chunks(self.store_dir, manifest)
+        shutil.rmtree(self.upload_dir, ignore_errors=True)
+        os.makedirs(self.upload_dir)
+        with open(os.path.join(self.upload_dir, "missing"), "w") as file:
+            file.write("".join(f"{digest}\n" for digest in missing))
+        return len(manifest), len(missing)
+
+    @defer.inlineCallbacks
+    def run(self):
+        total, missing = yield threads.deferToThread(self.negotiate)
+        self.descriptionDone = f"{missing}/{total} chunks to upload"
+        return util.SUCCESS
+
+class StoreArtifactChunks(buildstep.BuildStep):
+    """Move the artifact chunks uploaded by the worker to the chunk store
+
+    The step fails if the store still misses chunks of the manifest
+    """
+
+    renderables = ['manifest', 'upload_dir']
+
+    def __init__(self, manifest, upload_dir,
+                 store_dir=chunkstore.CHUNK_STORE_DIR, **kwargs):
+        self.manifest = manifest
+        self.upload_dir = upload_dir
+        self.store_dir = store_dir
+        super().__init__(**kwargs)
+
+    def store(self):
+        added = chunkstore.add_chunks(self.store_dir,
+                                      os.path.join(self.upload_dir, "chunks"))
+        shutil.rmtree(self.upload_dir, ignore_errors=True)
+        manifest = chunkstore.read_manifest(self.manifest)
+        return added, chunkstore.missing_chunks(self.store_dir, manifest)
+
+    @defer.inlineCallbacks
+    def run(self):
+        added, missing = yield threads.deferToThread(self.store)
+        if missing:
+            yield self.addCompleteLog('missing', "\n".join(missing))
+            self.descriptionDone = f"{len(missing)} chunks missing"
+            return util.FAILURE
+
+        self.descriptionDone = f"{added} chunks added"
+        return util.SUCCESS
+
+def UploadArtifactChunks(factory):
+    """Upload build_artifacts.tar to the chunk store of the master
+
+    Only the chunks that the store does not have are transferred. The
+    tarball can be reconstructed from its manifest with chunkstore.py, or
+    downloaded from the dashboard
+    """
+
+    artifacts_manifest = ReportPathRender("build_artifacts/", chunkstore.MANIFEST_SUFFIX)
+    stepArgs = dict(alwaysRun=True, doStepIf=hasReachedBarrier("test"))
+
+    factory.addStep(steps.FileDownload(name="copy the artifact chunking script",
+        workerdest=ARTIFACT_CHUNKS_SCRIPT,
+        mastersrc="artifact-chunks",
+        mode=0o755,
+        **stepArgs))
+    factory.addStep(steps.ShellCommand(name="Split the artifacts in chunks",
+        command=[ARTIFACT_CHUNKS_SCRIPT, "manifest",
+                 "build_artifacts.tar", "build_artifacts.chunks"],
+        **stepArgs))
+    factory.addStep(steps.FileUpload(name="Upload the artifacts manifest",
+        workersrc="build_artifacts.chunks",
+        masterdest=artifacts_manifest,
+        **stepArgs))
+    factory.addStep(NegotiateArtifactChunks(artifacts_manifest, ARTIFACT_CHUNKS_UPLOAD,
+        name="List the artifact chunks to upload",
+        **stepArgs))
+    factory.addStep(steps.FileDownload(name="Download the list of chunks to upload",
+        workerdest="build_artifacts.missing",
+        mastersrc=util.Interpolate("%(kw:upload)s/missing", upload=ARTIFACT_CHUNKS_UPLOAD),
+        **stepArgs))
+    factory.addStep(steps.ShellCommand(name="Pack the missing artifact chunks",
+        command=[ARTIFACT_CHUNKS_SCRIPT, "pack",
+                 "build_artifacts.tar", "build_artifacts.chunks",
+                 "build_artifacts.missing", "build_artifacts.upload"],
+        **stepArgs))
+    factory.addStep(steps.DirectoryUpload(name="Upload the missing artifact chunks",
+        workersrc="build_artifacts.upload",
+        masterdest=util.Interpolate("%(kw:upload)s/chunks", upload=ARTIFACT_CHUNKS_UPLOAD),
+        **stepArgs))
+    factory.addStep(StoreArtifactChunks(artifacts_manifest, ARTIFACT_CHUNKS_UPLOAD,
+        name="Store the artifact chunks",
+        **stepArgs))
+
+def BuildArtifacts(factory, workspace=None, compression="gzip", chunked=False):
+    """Create the build artifacts and upload them to build_artifacts/
+
+    If chunked is set, the artifacts tarball is stored in the master's chunk
+    store instead of being compressed and uploaded as a whole (see
+    UploadArtifactChunks)
+    """
+
+    backend = compressionBackend(compression)
+    artifacts_tar_name = f"build_artifacts.tar.{backend['suffix']}"
+
     workspaceArgs = []
     if workspace is not None:
         workspaceArgs = ['--workspace', workspace]
 
+    Barrier(factory, "artifacts",
+        alwaysRun=True,
+        doStepIf=hasReachedBarrier("test"))
     AutoprojStep(factory, "ci", "rebuild-root", 'buildbot-report/',
             CACHE_BUILD_DIR, "build_artifacts.tar", *workspaceArgs,
         name="Create the build artifacts tarball",
@@ -615,18 +2509,21 @@ def BuildArtifacts(factory, workspace=None):
         doStepIf=hasReachedBarrier("test")
     ))
 
-    factory.addStep(steps.ShellCommand(name="Compress the artifacts",
-        command=["gzip", "build_artifacts.tar"],
-        alwaysRun=True,
-        doStepIf=hasReachedBarrier("test")
-    ))
-
-    artifacts_tar    = ReportPathRender("build_artifacts/", ".tar.gz")
-    factory.addStep(steps.FileUpload(name="Download the build artifacts",
-        workersrc="build_artifacts.tar.gz",
-        masterdest=artifacts_tar,
-        alwaysRun=True,
-        doStepIf=hasReachedBarrier("test")))
+    if chunked:
+        UploadArtifactChunks(factory)
+    else:
+        factory.addStep(steps.ShellCommand(name="Compress the artifacts",
+            command=[*backend['command'], "build_artifacts.tar"],
+            alwaysRun=True,
+            doStepIf=hasReachedBarrier("test")
+        ))
+
+        artifacts_tar    = ReportPathRender("build_artifacts/", f".tar.{backend['suffix']}")
+        factory.addStep(steps.FileUpload(name="Download the build artifacts",
+            workersrc=artifacts_tar_name,
+            masterdest=artifacts_tar,
+            alwaysRun=True,
+            doStepIf=hasReachedBarrier("test")))
 
     artifacts_dpkg_orig = ReportPathRender("build_artifacts/", ".dpkg-orig")
     artifacts_dpkg_new = ReportPathRender("build_artifacts/", ".dpkg-new")
@@ -640,4 +2537,7 @@ def BuildArtifacts(factory, workspace=None):
         masterdest=artifacts_dpkg_new,
         alwaysRun=True,
         doStepIf=hasReachedBarrier("test")))
-
+    factory.addStep(RecordPhaseTimings(ReportPathRender("build_reports/", ""),
+        name="Record the phase timings",
+        alwaysRun=True,
+        doStepIf=hasReachedBarrier("test")))
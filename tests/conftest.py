@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The master's modules (rock, dashboard, ...) are loaded from master/ by
+# buildbot, not installed
+sys.path.insert(0, str(Path(__file__).parent.parent / "master"))
@@ -0,0 +1,53 @@
+import random
+
+import rock
+
+
+def layered_workspace(layer_sizes, seed=0):
+    """Dependency graph whose packages depend on packages of the layer below"""
+
+    rng = random.Random(seed)
+    dependencies = {}
+    previous = []
+    for lvl, size in enumerate(layer_sizes):
+        layer = [f"l{lvl}/p{i}" for i in range(size)]
+        for name in layer:
+            dependencies[name] = rng.sample(previous, min(2, len(previous)))
+        previous = layer
+    return dependencies
+
+
+def test_wide_layers_spread_across_shards():
+    dependencies = layered_workspace([80, 60, 40, 15, 5])
+    plan = rock.planBuildShards(dependencies, shard_count=4, max_stages=3)
+
+    assert len(plan) == 3
+    assert [len(shard) for shard in plan[0]] == [20, 20, 20, 20]
+    assert [len(shard) for shard in plan[1]] == [15, 15, 15, 15]
+
+
+def test_only_the_narrow_layers_are_merged():
+    dependencies = layered_workspace([80, 60, 40, 15, 5])
+    plan = rock.planBuildShards(dependencies, shard_count=4, max_stages=3)
+
+    last_stage = {name for shard in plan[2] for name in shard}
+    assert {name.split('/')[0] for name in last_stage} == {'l2', 'l3', 'l4'}
+
+
+def test_merged_stages_keep_dependencies_in_the_same_shard():
+    dependencies = layered_workspace([80, 60, 40, 15, 5])
+    plan = rock.planBuildShards(dependencies, shard_count=4, max_stages=3)
+
+    for stage in plan:
+        shard_of = {name: i for i, shard in enumerate(stage) for name in shard}
+        for name, i in shard_of.items():
+            for dep in dependencies[name]:
+                assert shard_of.get(dep, i) == i
+
+
+def test_every_package_is_planned_once():
+    dependencies = layered_workspace([80, 60, 40, 15, 5])
+    plan = rock.planBuildShards(dependencies, shard_count=4, max_stages=3)
+
+    planned = [name for stage in plan for shard in stage for name in shard]
+    assert sorted(planned) == sorted(dependencies)
@@ -0,0 +1,70 @@
+from twisted.internet import defer
+
+import rock
+
+
+class FakeData:
+    def __init__(self, buildsets):
+        self.buildsets = buildsets
+
+    def get(self, path):
+        if path[0] == 'sourcestamps':
+            return defer.succeed([{'changeid': path[1]}])
+        buildset = self.buildsets[int(path[1])]
+        if len(path) == 3:
+            return defer.succeed(buildset['properties'])
+        return defer.succeed(buildset)
+
+
+class FakeMaster:
+    def __init__(self, buildsets):
+        self.data = FakeData(buildsets)
+
+
+def buildset(bsid, name, revision, **props):
+    properties = {'virtual_builder_name': (name, 'Scheduler'),
+                  'virtual_builder_description': (f"https://github.com/{name}", 'Scheduler'),
+                  'scheduler': ('autoproj-daemon', 'Scheduler')}
+    properties.update({k: (v, 'Force Build Form') for k, v in props.items()})
+    return {
+        'bsid': bsid,
+        'sourcestamps': [{
+            'ssid': bsid, 'codebase': '', 'repository': 'https://github.com/org/buildconf',
+            'branch': 'refs/pull/1/head', 'project': 'org', 'patch': None,
+            'revision': revision
+        }],
+        'properties': properties
+    }
+
+
+def request(brid, bsid):
+    return {'buildrequestid': brid, 'buildsetid': bsid}
+
+
+def collapse(buildsets, new_br, old_br):
+    results = []
+    d = rock.collapseByVirtualBuilder(FakeMaster(buildsets), None, new_br, old_br)
+    d.addCallback(results.append)
+    return results[0]
+
+
+def test_newer_request_collapses_older_one_of_the_same_pr():
+    buildsets = {1: buildset(1, 'org:pr/1', 'a'), 2: buildset(2, 'org:pr/1', 'b')}
+    assert collapse(buildsets, request(2, 2), request(1, 1))
+
+
+def test_older_request_does_not_collapse_newer_one():
+    buildsets = {1: buildset(1, 'org:pr/1', 'a'), 2: buildset(2, 'org:pr/1', 'b')}
+    # Requests handed to the collapser out of order
+    assert not collapse(buildsets, request(1, 1), request(2, 2))
+
+
+def test_requests_of_different_prs_are_not_collapsed():
+    buildsets = {1: buildset(1, 'org:pr/1', 'a'), 2: buildset(2, 'org:pr/2', 'b')}
+    assert not collapse(buildsets, request(2, 2), request(1, 1))
+
+
+def test_requests_with_different_properties_are_not_collapsed():
+    buildsets = {1: buildset(1, 'org:pr/1', 'a'),
+                 2: buildset(2, 'org:pr/1', 'b', rebuild='base/cmake')}
+    assert not collapse(buildsets, request(2, 2), request(1, 1))
@@ -0,0 +1,38 @@
+import pytest
+from werkzeug.exceptions import NotFound
+
+import dashboard
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    (tmp_path / "build_reports" / "build-1").mkdir(parents=True)
+    (tmp_path / "build_artifacts").mkdir()
+    (tmp_path / "secret.log").write_text("secret")
+    monkeypatch.chdir(tmp_path)
+    return dashboard.Create('Autoproj')
+
+
+def test_build_packages_rejects_paths_outside_the_reports(app):
+    with app.test_request_context():
+        with pytest.raises(NotFound):
+            dashboard.api_build_packages("..")
+
+
+def test_report_files_outside_the_reports_are_not_found(app):
+    with app.test_request_context():
+        with pytest.raises(NotFound):
+            dashboard.resolve_report_file("build-1", "../../secret.log")
+
+
+def test_report_files_are_resolved(app, tmp_path):
+    log = tmp_path / "build_reports" / "build-1" / "pkg-build.log"
+    log.write_text("log")
+    with app.test_request_context():
+        assert dashboard.resolve_report_file("build-1", "pkg-build.log") == (log.resolve(), None)
+
+
+def test_artifacts_outside_the_artifacts_directory_are_not_found(app):
+    with app.test_request_context():
+        with pytest.raises(NotFound):
+            dashboard.artifacts_get("../secret")
@@ -0,0 +1,138 @@
+import json
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+
+MASTER_DIR = Path(__file__).parent.parent / "master"
+TEST_SHARDS = MASTER_DIR / "test-shards"
+OVERRIDE = MASTER_DIR / "99-test-shard-report.rb"
+
+# Mirrors autoproj's Autoproj::Ops::PhaseReporting, as far as the override
+# is concerned
+PHASE_REPORTING_STUB = """
+require 'json'
+module Autoproj
+    VERSION = 'stub'
+    module Ops
+        class PhaseReporting
+            def initialize(name, path, metadata_get)
+                @name = name
+                @path = path
+                @metadata_get = metadata_get
+            end
+
+            def create_report(packages)
+                info = packages.each_with_object({}) { |p, h| h[p] = { 'invoked' => true } }
+                File.write(@path, JSON.dump("#{@name}_report" => { 'packages' => info }))
+            end
+        end
+    end
+end
+"""
+
+# Stands for `autoproj ci test --interactive=f -k -pN PACKAGES...`
+FAKE_AUTOPROJ = PHASE_REPORTING_STUB + """
+load ENV['TEST_SHARD_OVERRIDE']
+packages = ARGV.drop(5)
+Autoproj::Ops::PhaseReporting.new('test', File.join(Dir.pwd, 'test_report.json'), nil).
+    create_report(packages)
+exit(packages.include?('failing') ? 1 : 0)
+"""
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    autoproj = tmp_path / ".autoproj" / "bin" / "autoproj"
+    autoproj.parent.mkdir(parents=True)
+    autoproj.write_text("#! /usr/bin/env ruby\n" + FAKE_AUTOPROJ)
+    autoproj.chmod(0o755)
+    return tmp_path
+
+
+def run_test_shards(workspace, plan, *options, env={}):
+    (workspace / "plan.txt").write_text(plan)
+    env = {**os.environ, 'TEST_SHARD_OVERRIDE': str(OVERRIDE), **env}
+    return subprocess.run(
+        [str(TEST_SHARDS), "plan.txt", *options, "--", "--interactive=f", "-k", "-p1"],
+        cwd=workspace, env=env, capture_output=True, text=True, timeout=60)
+
+
+def test_shard_reports_are_merged_in_the_test_report(workspace):
+    result = run_test_shards(workspace, "a b\nc\n")
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    report = json.loads((workspace / "test_report.json").read_text())
+    assert sorted(report['test_report']['packages']) == ['a', 'b', 'c']
+
+
+def test_a_failing_shard_fails_and_still_reports(workspace):
+    result = run_test_shards(workspace, "a\nfailing\n")
+
+    assert result.returncode == 1
+    report = json.loads((workspace / "test_report.json").read_text())
+    assert sorted(report['test_report']['packages']) == ['a', 'failing']
+
+
+def test_an_empty_plan_succeeds(workspace):
+    result = run_test_shards(workspace, "")
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert not (workspace / "test_report.json").exists()
+
+
+def test_omninames_instances_are_killed_on_exit(workspace, tmp_path_factory):
+    bin_dir = tmp_path_factory.mktemp("bin")
+    omninames = bin_dir / "omniNames"
+    omninames.write_text("#! /bin/bash\nexec sleep 600\n")
+    omninames.chmod(0o755)
+    datadir_base = tmp_path_factory.mktemp("omniNames") / "shard-"
+
+    result = run_test_shards(workspace, "a\nb\n", "--omniorb", env={
+        'OMNINAMES': str(omninames), 'NAMECLT': "true",
+        'OMNINAMES_DATADIR_BASE': str(datadir_base)})
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    ps = subprocess.run(["ps", "-eo", "args"], capture_output=True, text=True)
+    assert "sleep 600" not in ps.stdout
+
+
+def run_override(ruby_prelude, tmp_path):
+    script = ruby_prelude + """
+load ARGV[0]
+reporting = Autoproj::Ops::PhaseReporting.new('test', ARGV[1], nil)
+reporting.create_report(['a'])
+"""
+    env = {**os.environ, 'AUTOPROJ_TEST_SHARD_REPORT': str(tmp_path / "shard.json")}
+    return subprocess.run(
+        ["ruby", "-e", script, str(OVERRIDE), str(tmp_path / "test_report.json")],
+        env=env, capture_output=True, text=True)
+
+
+def test_the_override_redirects_the_test_report(tmp_path):
+    result = run_override(PHASE_REPORTING_STUB, tmp_path)
+
+    assert result.returncode == 0, result.stderr
+    assert not (tmp_path / "test_report.json").exists()
+    assert json.loads((tmp_path / "shard.json").read_text())['test_report']
+    assert (tmp_path / "shard.json.target").read_text() == str(tmp_path / "test_report.json")
+
+
+def test_the_override_refuses_an_unknown_phase_reporting(tmp_path):
+    stub = PHASE_REPORTING_STUB.replace(
+        "def initialize(name, path, metadata_get)", "def initialize(path, name, metadata_get)")
+    result = run_override(stub, tmp_path)
+
+    assert result.returncode != 0
+    assert "unsupported Autoproj::Ops::PhaseReporting" in result.stderr
+
+
+def test_the_override_supports_the_installed_autoproj(tmp_path):
+    if subprocess.run(["ruby", "-e", "require 'autoproj'"], capture_output=True).returncode != 0:
+        pytest.skip("autoproj is not installed")
+
+    result = run_override("require 'autoproj'\n", tmp_path)
+
+    assert result.returncode == 0, result.stderr
+    assert (tmp_path / "shard.json.target").exists()